@@ -0,0 +1,351 @@
+# A multi-process version of the server: [run] forks [workers] processes that
+# all accept clients on the same port (via SO_REUSEPORT, so the kernel spreads
+# connections across them), each running its own event loop on its own core.
+#
+# Users are partitioned between workers by a hash of their name (see
+# [partition_of]); the worker owning a user holds its [server.State] entry
+# (pending messages, login status), no matter which worker the user's client
+# happens to be connected to. Operations on a user owned by another worker are
+# forwarded to that worker over a Unix socket, using the same JSON-RPC stack
+# as the clients. A user logged in through another worker is represented in
+# the owner's [State] by a [RemoteSession], which forwards messages back to
+# the worker holding the connection.
+
+import asyncio
+import os
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import traceback
+import zlib
+from typing import Any, Union
+
+import jsonrpc
+from server import (
+    AlreadyLoggedIn,
+    LoggedIn,
+    Message,
+    MessageList,
+    Ok,
+    Session,
+    State,
+    User,
+    UserList,
+)
+import transport
+
+
+# Which of [workers] partitions [user] belongs to. This must agree between
+# processes, so we can't use [hash] (which is salted per process).
+def partition_of(user: User, workers: int) -> int:
+    return zlib.crc32(user.encode(transport.STRING_ENCODING)) % workers
+
+
+# Raised by [Worker.deliver] when the recipient isn't logged in through that
+# worker (any more), e.g. because its logout is still on the way to the owner
+class NotConnectedHere(jsonrpc.JsonRpcError):
+    code = 307
+    message = "user is not connected to this worker"
+
+    def __init__(self, s):
+        super().__init__(code=self.code, message=self.message, data=s)
+
+
+# Error raised by a peer, re-raised here so that it's passed on to the client
+# as-is
+def peer_error(payload: Any) -> jsonrpc.JsonRpcError:
+    return jsonrpc.JsonRpcError(
+        code=payload["code"], message=payload["message"], data=payload["data"]
+    )
+
+
+# Connections to the other workers, opened on first use
+class Peers:
+    paths: list[str]
+    links: dict[int, "asyncio.Future[jsonrpc.Session]"]
+
+    def __init__(self, paths: list[str]):
+        self.paths = paths
+        self.links = dict()
+
+    async def connect(self, idx: int) -> jsonrpc.Session:
+        reader, writer = await asyncio.open_unix_connection(self.paths[idx])
+        session = jsonrpc.spawn_session(reader, writer)
+        session.run_in_background(session.run_event_loop())
+        return session
+
+    async def link(self, idx: int) -> jsonrpc.Session:
+        # concurrent callers share a single connection attempt
+        if idx not in self.links:
+            self.links[idx] = asyncio.ensure_future(self.connect(idx))
+        return await self.links[idx]
+
+    # Call [method] on worker [idx] and return the result, raising the error
+    # it responds with, if any
+    async def call(self, idx: int, method: str, *params: Any) -> Any:
+        peer = await self.link(idx)
+        resp = await peer.request(method=method, params=list(params))
+        if resp.is_error:
+            raise peer_error(resp.payload)
+        return resp.payload
+
+    async def notify(self, idx: int, method: str, *params: Any) -> None:
+        peer = await self.link(idx)
+        await peer.request(method=method, params=list(params), is_notification=True)
+
+
+# Stands in (in the owning worker's [State]) for a user logged in through
+# another worker
+class RemoteSession:
+    # the worker that owns the user
+    owner: "Worker"
+    # the worker the user is connected to
+    worker: int
+    username: User
+
+    def __init__(self, owner: "Worker", worker: int, username: User):
+        self.owner = owner
+        self.worker = worker
+        self.username = username
+
+    async def receive_message(self, msg: Message) -> Ok:
+        try:
+            await self.owner.peers.call(
+                self.worker, "deliver", self.username, msg.to_jsonable_type()
+            )
+        except jsonrpc.JsonRpcError as e:
+            if e.code != NotConnectedHere.code:
+                raise
+            # The user logged out through that worker, but we haven't heard
+            # yet. Act as if we had, so the message is kept as pending (or
+            # goes to whichever session has replaced this one).
+            local = self.owner.local
+            status = local.known_users.get(self.username)
+            if isinstance(status, LoggedIn) and status.session is self:
+                local.handle_logout(self.username)
+            return await local.handle_send_message(msg)
+        return Ok()
+
+
+# The state of one worker: the partition of users it owns, plus the clients
+# connected to it. Presents the same interface to clients as [State], routing
+# each operation to the worker that owns the user involved.
+class Worker:
+    idx: int
+    workers: int
+    # the users in our partition
+    local: State
+    peers: Peers
+    # users owned by another worker that are logged in through us
+    sessions: dict[User, Session]
+    pending_jobs: set[asyncio.Task]
+
+    def __init__(self, idx: int, paths: list[str]):
+        self.idx = idx
+        self.workers = len(paths)
+        self.local = State()
+        self.peers = Peers(paths)
+        self.sessions = dict()
+        self.pending_jobs = set()
+
+    def owner(self, user: User) -> int:
+        return partition_of(user, self.workers)
+
+    def run_in_background(self, coro):
+        task = asyncio.create_task(coro)
+        self.pending_jobs.add(task)
+        task.add_done_callback(self.pending_jobs.discard)
+
+    # Client-facing operations (see [State])
+
+    async def handle_login(self, session: Session, user: User) -> MessageList:
+        owner = self.owner(user)
+        if owner == self.idx:
+            return self.local.handle_login(session, user)
+        if user in self.sessions:
+            raise AlreadyLoggedIn(user)
+        # The owner may [deliver] to us as soon as it has logged the user in,
+        # which can be before its reply reaches us, so register first
+        self.sessions[user] = session
+        try:
+            pending = await self.peers.call(owner, "login", user, self.idx)
+        except BaseException:
+            self.sessions.pop(user, None)
+            raise
+        return MessageList([Message(**msg) for msg in pending])
+
+    def handle_logout(self, user: User) -> None:
+        owner = self.owner(user)
+        if owner == self.idx:
+            self.local.handle_logout(user)
+            return
+        self.sessions.pop(user, None)
+        self.run_in_background(self.peers.notify(owner, "logout", user, self.idx))
+
+    async def handle_send_message(self, msg: Message) -> Ok:
+        owner = self.owner(msg.recipient)
+        if owner == self.idx:
+            return await self.local.handle_send_message(msg)
+        await self.peers.call(owner, "send_message", msg.to_jsonable_type())
+        return Ok()
+
+    async def create_user(self, name: User) -> Ok:
+        owner = self.owner(name)
+        if owner == self.idx:
+            return await self.local.create_user(name)
+        await self.peers.call(owner, "create_user", name)
+        return Ok()
+
+    async def list_users(self, *args) -> UserList:
+        others = [idx for idx in range(self.workers) if idx != self.idx]
+        results = await asyncio.gather(
+            *(self.peers.call(idx, "list_users") for idx in others)
+        )
+        users = (await self.local.list_users()).data
+        for result in results:
+            users.extend(result)
+        return UserList(users)
+
+    async def delete_user(self, user: User) -> Ok:
+        owner = self.owner(user)
+        if owner == self.idx:
+            return await self.local.delete_user(user)
+        await self.peers.call(owner, "delete_user", user)
+        return Ok()
+
+    # Operations on our own partition, on behalf of other workers
+
+    async def peer_login(self, user: User, worker: int) -> MessageList:
+        session = RemoteSession(self, worker, user)
+        return self.local.handle_login(session, user)  # type: ignore
+
+    # Only log [user] out if it is still logged in through [worker]: if a
+    # [deliver] to it failed in the meantime, it already has been (and may
+    # have pending messages, or have logged in again elsewhere)
+    async def peer_logout(self, user: User, worker: int) -> Ok:
+        status = self.local.known_users.get(user)
+        if (
+            isinstance(status, LoggedIn)
+            and isinstance(status.session, RemoteSession)
+            and status.session.worker == worker
+        ):
+            self.local.handle_logout(user)
+        return Ok()
+
+    async def peer_send_message(self, msg: dict[str, Any]) -> Ok:
+        return await self.local.handle_send_message(Message(**msg))
+
+    # Hand a message to a client connected to us, whose user another worker
+    # owns
+    async def deliver(self, user: User, msg: dict[str, Any]) -> Ok:
+        session = self.sessions.get(user)
+        if session is None:
+            # logged out since the owner last heard; see
+            # [RemoteSession.receive_message]
+            raise NotConnectedHere(user)
+        return await session.receive_message(Message(**msg))
+
+    # XXX: This is copy-pasted from [State.handle_incoming].
+    async def handle_incoming(self, reader, writer) -> None:
+        session = jsonrpc.spawn_session(reader, writer)
+        user_session = Session(
+            session, self.handle_login, self.handle_logout, self.handle_send_message
+        )
+
+        session.register_handler("login", user_session.login)
+        session.register_handler("create_user", self.create_user)
+        session.register_handler("list_users", self.list_users)
+        session.register_handler("delete_user", self.delete_user)
+        session.register_handler("send", user_session.send_message)
+
+        await session.run_event_loop()
+        user_session.cleanup()
+
+    async def handle_peer(self, reader, writer) -> None:
+        session = jsonrpc.spawn_session(reader, writer)
+
+        session.register_handler("login", self.peer_login)
+        session.register_handler("logout", self.peer_logout)
+        session.register_handler("send_message", self.peer_send_message)
+        session.register_handler("create_user", self.local.create_user)
+        session.register_handler("list_users", self.local.list_users)
+        session.register_handler("delete_user", self.local.delete_user)
+        session.register_handler("deliver", self.deliver)
+
+        await session.run_event_loop()
+
+
+async def serve_worker(
+    idx: int, paths: list[str], listener: socket.socket, peer_listener: socket.socket
+) -> None:
+    worker = Worker(idx, paths)
+    server = await asyncio.start_server(worker.handle_incoming, sock=listener)
+    peer_server = await asyncio.start_unix_server(
+        worker.handle_peer, sock=peer_listener
+    )
+    async with server, peer_server:
+        await asyncio.gather(server.serve_forever(), peer_server.serve_forever())
+
+
+def listen_unix(path: str) -> socket.socket:
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(path)
+    sock.listen()
+    return sock
+
+
+# Run the server as [workers] processes, returning once they have all exited.
+# Every listening socket is created before forking, so a worker can connect to
+# its peers (and clients can connect at all) before they start accepting.
+def run(host: str, port: Union[int, str], workers: int) -> None:
+    ipc_dir = tempfile.mkdtemp(prefix="chat-")
+    paths = [os.path.join(ipc_dir, f"worker-{idx}.sock") for idx in range(workers)]
+    listeners = [
+        socket.create_server((host, int(port)), reuse_port=True) for _ in range(workers)
+    ]
+    peer_listeners = [listen_unix(path) for path in paths]
+    pids = []
+
+    try:
+        for idx in range(workers):
+            pid = os.fork()
+            if pid == 0:
+                # [os._exit] skips the usual cleanup, so report a crash
+                # ourselves (and through the exit status)
+                status = 1
+                try:
+                    for other in range(workers):
+                        if other != idx:
+                            listeners[other].close()
+                            peer_listeners[other].close()
+                    asyncio.run(
+                        serve_worker(idx, paths, listeners[idx], peer_listeners[idx])
+                    )
+                    status = 0
+                except Exception:
+                    traceback.print_exc()
+                finally:
+                    sys.stderr.flush()
+                    os._exit(status)
+            pids.append(pid)
+
+        # the workers have their own copies now
+        for sock in listeners + peer_listeners:
+            sock.close()
+        # make sure the workers are taken down with us
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        while len(pids) > 0:
+            pid, status = os.wait()
+            pids.remove(pid)
+            code = os.waitstatus_to_exitcode(status)
+            if code != 0:
+                print(f"worker {pid} exited with status {code}", file=sys.stderr)
+    finally:
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        shutil.rmtree(ipc_dir, ignore_errors=True)
@@ -1,4 +1,5 @@
 import asyncio
+import inspect
 from dataclasses import dataclass
 from typing import Optional, Union, Callable, NewType, Awaitable
 
@@ -96,8 +97,12 @@ class AlreadyLoggedInSession(jsonrpc.JsonRpcError):
 class Session:
     owner: jsonrpc.Session
     username: Optional[User]
-    # [login_handler] will raise one of the above exceptions on failure.
-    login_handler: Callable[["Session", User], MessageList]
+    # [login_handler] will raise one of the above exceptions on failure. It
+    # may be a coroutine function, if logging in means asking another process
+    # (see [cluster.Worker]).
+    login_handler: Callable[
+        ["Session", User], Union[MessageList, Awaitable[MessageList]]
+    ]
     # logging out is idempotent, so [logout_handler] should not fail.
     logout_handler: Callable[[User], None]
     message_handler: Callable[[Message], Awaitable[Ok]]
@@ -105,7 +110,9 @@ class Session:
     def __init__(
         self,
         owner: jsonrpc.Session,
-        login_handler: Callable[["Session", User], MessageList],
+        login_handler: Callable[
+            ["Session", User], Union[MessageList, Awaitable[MessageList]]
+        ],
         logout_handler: Callable[[User], None],
         message_handler: Callable[[Message], Awaitable[Ok]],
     ):
@@ -119,8 +126,13 @@ class Session:
         if self.username is not None:
             raise AlreadyLoggedInSession(self.username)
 
+        pending_msgs = self.login_handler(self, username)
+        if inspect.isawaitable(pending_msgs):
+            pending_msgs = await pending_msgs
+        # only once logged in, so that [cleanup] doesn't log out a user this
+        # session failed to log in as
         self.username = username
-        return self.login_handler(self, username)
+        return pending_msgs
 
     async def send_message(self, text: str, recipient: User) -> Ok:
         if self.username is None:
@@ -1,26 +1,31 @@
 import struct
 import asyncio
-from collections import defaultdict, abc
-from typing import NewType, DefaultDict
+from collections import abc
+from typing import NewType
 
 MsgId = NewType("MsgId", int)
 
 # 4 bytes
-MAX_MSG_SIZE = 1 << 32 - 1
+MAX_MSG_SIZE = (1 << 32) - 1
 MAX_ID = 1 << 32
 
 # > = big endian
-# l = 4 bytes (size)
-# l = 4 bytes (id)
-# b = 1 byte (more?)
-HEADER_FORMAT = ">llb"
-HEADER_SIZE = 4 + 4 + 1
+# L = 4 bytes (size)
+# L = 4 bytes (id)
+# B = 1 byte (more?)
+#
+# Both 4-byte fields are unsigned; with signed fields, any size or id at or
+# above [2**31] would fail to pack (or unpack to a negative length).
+HEADER_FORMAT = ">LLB"
+# Compiling the format once saves re-parsing it on every packet
+HEADER = struct.Struct(HEADER_FORMAT)
+HEADER_SIZE = HEADER.size
 
 STRING_ENCODING = "utf8"
 
 # Format header data as bytes according to HEADER_FORMAT
 def format_header(*, size: int, id: MsgId, more: bool):
-    return struct.pack(HEADER_FORMAT, size, id, more)
+    return HEADER.pack(size, id, more)
 
 
 # Calculate the next message ID
@@ -39,14 +44,18 @@ class Session(abc.AsyncIterator[bytes]):
     # [self.pending_msgs] is safe provided that we don't [await] while the
     # dictionary is in some intermediate state. Also, dictionaries should have
     # atomic operations when used with primitive keys, so it'd be fine anyway.
-    pending_msgs: DefaultDict[MsgId, bytes]
+    #
+    # Chunks are collected in a list and joined once the final chunk arrives,
+    # so reassembling a message copies each byte once rather than once per
+    # chunk (as repeated [bytes +=] would).
+    pending_msgs: dict[MsgId, list[bytes]]
 
     # Initialize session
     def __init__(self, reader, writer):
         self.curr_id = MsgId(0)
         self.reader = reader
         self.writer = writer
-        self.pending_msgs = defaultdict(bytes)
+        self.pending_msgs = dict()
 
     # Get the next fresh message ID in this session
     def fresh_id(self) -> MsgId:
@@ -75,19 +84,28 @@ class Session(abc.AsyncIterator[bytes]):
     async def recv_single(self) -> bytes:
         # loop to receive all incoming packets
         while True:
-            # for each packet, read and unpack header, then read chunk
-            header = await self.reader.read(HEADER_SIZE)
-            size, id, more = struct.unpack(HEADER_FORMAT, header)
-            chunk = await self.reader.read(size)
+            # for each packet, read and unpack header, then read chunk.
+            # [reader.read(n)] may return fewer than [n] bytes if the packet
+            # was split in transit, so we must use [readexactly] here. If the
+            # connection closes partway, this raises [IncompleteReadError]
+            # (a subclass of [EOFError]).
+            header = await self.reader.readexactly(HEADER_SIZE)
+            size, id, more = HEADER.unpack(header)
+            chunk = await self.reader.readexactly(size)
             id = MsgId(id)
+            chunks = self.pending_msgs.get(id)
+            # fast path: a single-packet message needs no reassembly
+            if chunks is None and not more:
+                return chunk
             # add this chunk to the corresponding pending message by id
-            self.pending_msgs[id] += chunk
+            if chunks is None:
+                chunks = self.pending_msgs[id] = []
+            chunks.append(chunk)
             # if this is the last chunk, the message is fully received
             if not more:
-                payload = self.pending_msgs[id]
                 # delete from pending and return full message
                 del self.pending_msgs[id]
-                return payload
+                return b"".join(chunks)
 
     # Initialize iterator for session
     def __aiter__(self) -> abc.AsyncIterator[bytes]:
@@ -5,6 +5,26 @@ import server
 
 import argparse
 
+# Event loop implementations [--loop] accepts. "auto" means uvloop if it is
+# installed, and asyncio's own loop otherwise.
+LOOPS = ("auto", "asyncio", "uvloop")
+
+
+# Make [asyncio.run] use the event loop named by [loop], and return the name
+# of the one actually installed
+def install_loop(loop: str) -> str:
+    if loop == "asyncio":
+        return "asyncio"
+    try:
+        import uvloop  # type: ignore
+    except ImportError:
+        if loop == "uvloop":
+            print("uvloop is not installed; falling back to the asyncio event loop")
+        return "asyncio"
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    return "uvloop"
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
         prog="chat server demo", description="cs262 design 1"
@@ -12,8 +32,10 @@ if __name__ == "__main__":
     parser.add_argument("command", choices=["client", "server"])
     parser.add_argument("host")
     parser.add_argument("port")
+    parser.add_argument("--loop", choices=LOOPS, default="auto")
 
     args = parser.parse_args()
+    install_loop(args.loop)
 
     if args.command == "client":
         asyncio.run(client.main(args.host, args.port))
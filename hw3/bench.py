@@ -0,0 +1,102 @@
+# Rough throughput benchmark for the transport/jsonrpc stack, run once on
+# asyncio's own event loop and once on uvloop (if installed):
+#
+#   $ python3 bench.py [--clients N] [--requests N] [--window N]
+#
+# Each client connects to a local server, then sends [--requests] pipelined
+# calls to a trivial (inline) handler, keeping [--window] outstanding at a
+# time. We report connections/s (connect + first round trip, all clients at
+# once) and requests/s.
+
+import argparse
+import asyncio
+import time
+from typing import Any, Callable
+
+from common import Ok
+import jsonrpc
+
+
+def echo(x: int) -> Ok:
+    return Ok()
+
+
+# Every session's event loop, on both ends, so that we can wait for them all
+# to finish before tearing down the loop
+sessions_running: set[asyncio.Task] = set()
+
+
+async def serve(reader, writer) -> None:
+    session = jsonrpc.spawn_session(reader, writer)
+    session.register_handler("echo", echo, inline=True)
+    sessions_running.add(session.run_in_background(session.run_event_loop()))
+
+
+async def connect(port: int) -> jsonrpc.Session:
+    session = jsonrpc.spawn_session(*await asyncio.open_connection("127.0.0.1", port))
+    sessions_running.add(session.run_in_background(session.run_event_loop()))
+    await session.request(method="echo", params=[0])
+    return session
+
+
+async def run_client(session: jsonrpc.Session, requests: int, window: int) -> None:
+    calls = jsonrpc.RequestWindow(session, window)
+    for i in range(requests):
+        await calls.submit(method="echo", params=[i])
+    await calls.drain()
+
+
+async def bench(clients: int, requests: int, window: int) -> dict[str, float]:
+    server = await asyncio.start_server(serve, "127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+    async with server:
+        started = time.perf_counter()
+        sessions = await asyncio.gather(*(connect(port) for _ in range(clients)))
+        connected = time.perf_counter()
+        await asyncio.gather(
+            *(run_client(session, requests, window) for session in sessions)
+        )
+        finished = time.perf_counter()
+        for session in sessions:
+            session.close()
+        await asyncio.gather(*sessions_running, return_exceptions=True)
+        sessions_running.clear()
+    return {
+        "connections/s": clients / (connected - started),
+        "requests/s": clients * requests / (finished - connected),
+    }
+
+
+def run_on(new_loop: Callable[[], asyncio.AbstractEventLoop], *args: Any):
+    loop = new_loop()
+    try:
+        return loop.run_until_complete(bench(*args))
+    finally:
+        loop.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog="bench", description="compare event loops on the jsonrpc stack"
+    )
+    parser.add_argument("--clients", type=int, default=100)
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--window", type=int, default=64)
+    args = parser.parse_args()
+
+    loops: dict[str, Callable[[], asyncio.AbstractEventLoop]] = {
+        "asyncio": asyncio.new_event_loop
+    }
+    try:
+        import uvloop  # type: ignore
+
+        loops["uvloop"] = uvloop.new_event_loop
+    except ImportError:
+        print("uvloop is not installed; only benchmarking asyncio")
+
+    for name, new_loop in loops.items():
+        result = run_on(new_loop, args.clients, args.requests, args.window)
+        print(
+            f"{name:>8}: {result['connections/s']:10.1f} connections/s"
+            f" {result['requests/s']:10.1f} requests/s"
+        )
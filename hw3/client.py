@@ -3,45 +3,42 @@
 # deserialization code in [jsonrpc.py] to fix that.
 
 import asyncio
-from typing import Optional, NewType, Any
+from typing import Optional, Any
 from fnmatch import fnmatch
 import aioconsole  # type: ignore
 
 from jsonrpc import spawn_session, Session
-from common import Disconnected
+from common import Address, Disconnected, User
 import config
 
-User = NewType("User", str)
-
 # Design decision: we do not need a client class,
 # because we will simply start up new clients by running the
 # file multiple times. Since a client doesn't have much internal
 # state (unlike a server), there's no need for a client class.
 
-# Client keeps track of the session it has going with server
-# and of the user that is logged in
-session: Session
+# Client keeps track of the sessions it has going with the servers (one per
+# shard) and of the user that is logged in
+sessions: dict[int, Session] = {}
 client_user: Optional[User] = None
-writer: asyncio.StreamWriter
-
+cfg: config.Config
 
-# Connect to server
-# takes a list of server ports and connects to the one
-# with the lowest number
-async def connect(cfg: config.Config):
-    global session
-    global writer
 
-    for (host, port) in cfg.servers:
+# Connect to the primary of one shard
+# takes the shard's chain of servers and connects to the first
+# one that accepts clients
+async def connect_shard(servers: list[Address]) -> Session:
+    for (host, port) in servers:
         try:
             # connect to the socket and start a session with the server
             reader, writer = await asyncio.open_connection(host, port)
-            session = spawn_session(reader, writer)
+            session = spawn_session(reader, writer, compression="zlib")
             session.run_in_background(session.run_event_loop())
             resp = await session.request(method="register_client", params=[])
             if resp.payload == "ok":
                 session.register_handler("receive_message", receive_message)
-                return
+                # switch to a binary encoding if both sides have one
+                await session.negotiate_encoding("msgpack", "cbor")
+                return session
         except:
             pass
     else:
@@ -49,6 +46,30 @@ async def connect(cfg: config.Config):
         exit(1)
 
 
+# Connect to every shard we don't already have a working session with, and
+# return the indices of the shards (re)connected. The sessions with the other
+# shards are kept, along with the login on them, if any.
+async def connect(config_: config.Config) -> list[int]:
+    global cfg
+    cfg = config_
+    reconnected = []
+    for idx, shard in enumerate(cfg.shards):
+        old = sessions.get(idx)
+        if old is not None:
+            if old.is_running:
+                continue
+            old.close()
+        sessions[idx] = await connect_shard(shard.servers)
+        reconnected.append(idx)
+    return reconnected
+
+
+# The session with the shard [user] lives on, which all requests about
+# [user] go to
+def session_for(user: User) -> Session:
+    return sessions[cfg.shard_of(user)]
+
+
 # Send login request to server
 async def login_user(user: User):
     global client_user
@@ -58,7 +79,7 @@ async def login_user(user: User):
 
     # send the request to server-side login method, with specified parameters
     params = [user]
-    result = await session.request(method="login", params=params)
+    result = await session_for(user).request(method="login", params=params)
     # if the result is an error, print error message
     if result.is_error:
         print(
@@ -85,7 +106,7 @@ async def login_user(user: User):
 async def create_user(user: User):
     # send the request to server-side create_user method, with specified parameters
     params = [user]
-    result = await session.request(method="create_user", params=params)
+    result = await session_for(user).request(method="create_user", params=params)
     # if server gives error, print it
     if result.is_error:
         print("Error creating user " + user + ": " + result.payload["message"] + ".\n")  # type: ignore
@@ -99,31 +120,47 @@ async def create_user(user: User):
 
 # Send list accounts request to server
 async def list_accounts(filter: str):
-    result = await session.request(method="list_users", params=[])
-    # if server gives error, print it
-    if result.is_error:
-        print("Error listing accounts: " + result.payload["message"] + ".\n")  # type: ignore
-    # if server confirms, print the filtered account names
-    elif isinstance(result.payload, list):
-        lst = result.payload
-        filtered = [u if fnmatch(u, filter) else "" for u in lst]
-        while "" in filtered:
-            filtered.remove("")
-        if len(filtered) == 0:
-            print("No accounts matching this filter.")
+    # each shard only knows about its own users
+    results = await asyncio.gather(
+        *(
+            session.request(method="list_users", params=[])
+            for session in sessions.values()
+        )
+    )
+    lst: list[str] = []
+    for result in results:
+        # if server gives error, print it
+        if result.is_error:
+            print("Error listing accounts: " + result.payload["message"] + ".\n")  # type: ignore
+            return
+        elif isinstance(result.payload, list):
+            lst.extend(result.payload)
         else:
-            print("Accounts matching filter " + filter + ":")
-            for name in filtered:
-                print(name)
+            # this should not happen
+            print("Something went wrong. Please try again.\n")
+            return
+    # print the filtered account names
+    filtered = [u if fnmatch(u, filter) else "" for u in lst]
+    while "" in filtered:
+        filtered.remove("")
+    if len(filtered) == 0:
+        print("No accounts matching this filter.")
     else:
-        # this should not happen
-        print("Something went wrong. Please try again.\n")
+        print("Accounts matching filter " + filter + ":")
+        for name in filtered:
+            print(name)
 
 
 # Send message send request to server
 async def send(msg: str, user: User):
     global client_user
     params = [msg, user]
+    # the sender's server passes the message on to the recipient's shard, if
+    # need be. (If nobody is logged in, any server will tell us so.)
+    if client_user is None:
+        session = next(iter(sessions.values()))
+    else:
+        session = session_for(client_user)
     result = await session.request(method="send", params=params)
     # if server gives error, print it
     if result.is_error:
@@ -139,7 +176,7 @@ async def send(msg: str, user: User):
 # Send delete account request to server
 async def delete_user(user: User):
     params = [user]
-    result = await session.request(method="delete_user", params=params)
+    result = await session_for(user).request(method="delete_user", params=params)
     # if server gives error, print it
     if result.is_error:
         print("Error deleting user " + user + ": " + result.payload["message"] + ".\n")  # type: ignore
@@ -156,13 +193,15 @@ async def receive_message(m: dict[str, Any]):
     print(m["sender"] + ": " + m["content"] + "\n")
 
 
-# Close the socket connection client-side
+# Close the socket connections client-side
 async def close():
-    global writer, session, client_user
-    session = None
+    global client_user
     client_user = None
-    writer.close()
-    await writer.wait_closed()
+    for session in sessions.values():
+        writer = session.session.writer
+        writer.close()
+        await writer.wait_closed()
+    sessions.clear()
 
 
 # in main, do the connect and setup and UI
@@ -204,10 +243,11 @@ async def main():
     while True:
         try:
             # connect to server
-            await connect(cfg)
+            reconnected = await connect(cfg)
             print("Connected to server.\n")
 
-            if (client_user != None):
+            # the login only needs redoing if it was on a lost connection
+            if client_user != None and cfg.shard_of(client_user) in reconnected:
                 user = client_user
                 client_user = None
                 await login_user(user)
@@ -1,43 +1,168 @@
 from dataclasses import dataclass
+from functools import cached_property
+from typing import Optional
 import json
 
-from common import Host, Port, Address
+from common import Host, Port, Address, User
+import sharding
+import transport
 
 DEFAULT_CONFIG = "config.json"
 
+# Default limits on concurrently-handled requests; see [jsonrpc.Session] and
+# [jsonrpc.GLOBAL_JOBS]
+DEFAULT_MAX_JOBS_PER_SESSION = 64
+DEFAULT_MAX_JOBS = 4096
+# Default limits on memory used by incoming messages; see
+# [transport.DEFAULT_MAX_MESSAGE_SIZE] and [transport.GLOBAL_REASSEMBLY]
+DEFAULT_MAX_MESSAGE_SIZE = transport.DEFAULT_MAX_MESSAGE_SIZE
+DEFAULT_MAX_PENDING_BYTES = transport.DEFAULT_MAX_PENDING_BYTES
+DEFAULT_MAX_REASSEMBLY_BYTES = transport.DEFAULT_GLOBAL_REASSEMBLY_LIMIT
 
+# Group commit settings; see [server.Db]. Mutations within [commit_window]
+# seconds of each other share a write and fsync, up to [commit_batch] of them.
+DEFAULT_COMMIT_WINDOW = 0.002
+DEFAULT_COMMIT_BATCH = 256
+# Size (in bytes) past which the log is compacted into a snapshot; see
+# [server.Db]
+DEFAULT_COMPACT_BYTES = 64 * 1024 * 1024
+
+# Replication settings; see [server.State.replicate]. A backup that has
+# fallen more than [replication_log] records behind is sent a full snapshot
+# instead, [snapshot_chunk] users at a time. At most [replication_window]
+# records are sent down the chain ahead of its acknowledgements.
+DEFAULT_REPLICATION_LOG = 65536
+DEFAULT_SNAPSHOT_CHUNK = 1024
+DEFAULT_REPLICATION_WINDOW = 4096
+
+# Event loop to run on; see [main.install_loop]
+DEFAULT_LOOP = "auto"
+
+
+# A single replica chain, holding the users that hash to it (see [sharding])
 @dataclass
-class Config:
+class Shard:
+    name: str
+    # the chain, primary first
     servers: list[Address]
 
+
+@dataclass
+class Config:
+    shards: list[Shard]
+    max_jobs_per_session: Optional[int] = DEFAULT_MAX_JOBS_PER_SESSION
+    max_jobs: Optional[int] = DEFAULT_MAX_JOBS
+    max_message_size: int = DEFAULT_MAX_MESSAGE_SIZE
+    max_pending_bytes: int = DEFAULT_MAX_PENDING_BYTES
+    max_reassembly_bytes: int = DEFAULT_MAX_REASSEMBLY_BYTES
+    # If set, print request statistics (see [metrics]) every [stats_interval]
+    # seconds
+    stats_interval: Optional[float] = None
+    loop: str = DEFAULT_LOOP
+    commit_window: float = DEFAULT_COMMIT_WINDOW
+    commit_batch: int = DEFAULT_COMMIT_BATCH
+    compact_bytes: int = DEFAULT_COMPACT_BYTES
+    replication_log: int = DEFAULT_REPLICATION_LOG
+    snapshot_chunk: int = DEFAULT_SNAPSHOT_CHUNK
+    replication_window: int = DEFAULT_REPLICATION_WINDOW
+    # Known only to our servers; the primaries of different shards present it
+    # to each other (see [server.State.accept_shard_peer])
+    shard_secret: Optional[str] = None
+
+    # Every server, across all shards
+    @property
+    def servers(self) -> list[Address]:
+        return [server for shard in self.shards for server in shard.servers]
+
+    @cached_property
+    def ring(self) -> sharding.HashRing:
+        return sharding.HashRing([shard.name for shard in self.shards])
+
     def __contains__(self, server: Address):
         return server in self.servers
 
     def __getitem__(self, idx: int):
         return self.servers[idx]
 
+    # Index of the shard [user] lives on
+    def shard_of(self, user: User) -> int:
+        return self.ring.shard_of(user)
+
+    # Index of the shard [addr] serves
+    def shard_index(self, addr: Address) -> int:
+        for idx, shard in enumerate(self.shards):
+            if addr in shard.servers:
+                return idx
+        raise ValueError(f"{addr} is not in any shard")
+
+    # The chain [addr] is part of
+    def chain(self, addr: Address) -> list[Address]:
+        return self.shards[self.shard_index(addr)].servers
+
     def am_i_primary(self, addr: Address) -> bool:
         host, port = addr
-        return self.servers[0] == (host, port)
+        return self.chain(addr)[0] == (host, port)
 
     def preceding(self, addr: Address) -> list[Address]:
-        my_idx = self.servers.index(addr)
-        return self.servers[:my_idx]
+        chain = self.chain(addr)
+        my_idx = chain.index(addr)
+        return chain[:my_idx]
 
     def following(self, addr: Address) -> list[Address]:
-        my_idx = self.servers.index(addr)
-        return self.servers[my_idx + 1 :]
+        chain = self.chain(addr)
+        my_idx = chain.index(addr)
+        return chain[my_idx + 1 :]
+
+
+def parse_servers(servers) -> list[Address]:
+    return [(Host(server["host"]), Port(int(server["port"]))) for server in servers]
 
 
 def load(config=DEFAULT_CONFIG) -> Config:
     with open(config, "r") as f:
         data = json.load(f)
 
-    servers = data["servers"]
+    # A config with just a list of [servers] is a single shard. Otherwise,
+    # every shard must be named: users are placed by name (see [sharding]),
+    # and a default like the shard's position would move them whenever the
+    # list was reordered.
+    if "shards" in data:
+        shards = []
+        for idx, shard in enumerate(data["shards"]):
+            if "name" not in shard:
+                raise ValueError(f"{config}: shard {idx} has no name")
+            shards.append(Shard(shard["name"], parse_servers(shard["servers"])))
+    else:
+        shards = [Shard("0", parse_servers(data["servers"]))]
+    # without it, servers of different shards couldn't pass messages on to
+    # each other
+    if len(shards) > 1 and data.get("shard_secret") is None:
+        raise ValueError(f"{config}: several shards but no shard_secret")
+    limits = data.get("limits", {})
+    persistence = data.get("persistence", {})
+    replication = data.get("replication", {})
 
     # In a real app, we'd do some validation here
     result = Config(
-        [(Host(server["host"]), Port(int(server["port"]))) for server in servers]
+        shards,
+        max_jobs_per_session=limits.get(
+            "max_jobs_per_session", DEFAULT_MAX_JOBS_PER_SESSION
+        ),
+        max_jobs=limits.get("max_jobs", DEFAULT_MAX_JOBS),
+        max_message_size=limits.get("max_message_size", DEFAULT_MAX_MESSAGE_SIZE),
+        max_pending_bytes=limits.get("max_pending_bytes", DEFAULT_MAX_PENDING_BYTES),
+        max_reassembly_bytes=limits.get(
+            "max_reassembly_bytes", DEFAULT_MAX_REASSEMBLY_BYTES
+        ),
+        stats_interval=data.get("stats_interval"),
+        loop=data.get("loop", DEFAULT_LOOP),
+        commit_window=persistence.get("commit_window", DEFAULT_COMMIT_WINDOW),
+        commit_batch=persistence.get("commit_batch", DEFAULT_COMMIT_BATCH),
+        compact_bytes=persistence.get("compact_bytes", DEFAULT_COMPACT_BYTES),
+        replication_log=replication.get("log_entries", DEFAULT_REPLICATION_LOG),
+        snapshot_chunk=replication.get("snapshot_chunk", DEFAULT_SNAPSHOT_CHUNK),
+        replication_window=replication.get("window", DEFAULT_REPLICATION_WINDOW),
+        shard_secret=data.get("shard_secret"),
     )
 
     return result
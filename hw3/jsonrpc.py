@@ -6,15 +6,21 @@
 # - Requests must have a `params` field containing a list; unitary endpoints
 #   should be passed an empty list. Keyword arguments are disallowed.
 # - The `id` field will never contain a NULL value.
-# - Batch requests are disallowed.
+# - Batch requests are supported, but each element of a batch must be a request
+#   (or, in the other direction, a response); see [Session.request_batch].
+# - After negotiating it (see [Session.negotiate_encoding]), either side may
+#   send MessagePack or CBOR instead of JSON.
 
 import asyncio
-import json
+import inspect
+import typing
 from collections.abc import Coroutine
-from typing import NewType, Optional, Any, Callable, TypeVar, Generic
+from typing import NewType, Optional, Any, Callable, Awaitable, TypeVar, Union
 from typing_extensions import Protocol
 
-from common import Disconnected
+from common import Disconnected, Ok
+import metrics
+import serde
 import transport
 
 
@@ -54,8 +60,12 @@ class Request:
         self.id = id
 
     # Convert this request to jsonrpc format
-    def serialize(self) -> Any:
-        # first, collect the data into a dictionary
+    def serialize(self, codec: serde.Codec = serde.DEFAULT) -> bytes:
+        # convert the dictionary to bytes
+        return codec.dumps(self.to_jsonable_type())
+
+    # Collect the data into a dictionary
+    def to_jsonable_type(self) -> Any:
         t: dict[str, Any] = {
             "jsonrpc": "2.0",
             "method": self.method,
@@ -64,8 +74,7 @@ class Request:
         # set the request ID if it exists
         if self.id is not None:
             t["id"] = self.id
-        # then, convert the dictionary to a string
-        return json.dumps(t)
+        return t
 
     # Is this request a notification?
     # (notifications do not have IDs)
@@ -73,6 +82,24 @@ class Request:
         return self.id is None
 
 
+# A notification that is serialized at most once per codec, however many
+# sessions it is sent on (see [Session.notify]). This is meant for fan-out of
+# the same message to many recipients.
+class PreparedNotification:
+    req: Request
+    encoded: dict[str, bytes]
+
+    def __init__(self, *, method, params):
+        self.req = Request(method=method, params=params, id=None)
+        self.encoded = dict()
+
+    def serialize(self, codec: serde.Codec = serde.DEFAULT) -> bytes:
+        payload = self.encoded.get(codec.name)
+        if payload is None:
+            payload = self.encoded[codec.name] = self.req.serialize(codec)
+        return payload
+
+
 def parse_request(obj) -> Request:
     if "method" not in obj or "params" not in obj:
         raise ValueError
@@ -123,7 +150,10 @@ class Response:
         self.is_error = is_error
 
     # Convert this response to jsonrpc format
-    def serialize(self) -> str:
+    def serialize(self, codec: serde.Codec = serde.DEFAULT) -> bytes:
+        return codec.dumps(self.to_jsonable_type())
+
+    def to_jsonable_type(self) -> Any:
         t: dict[str, Any] = {
             "jsonrpc": "2.0",
             "id": self.id,
@@ -134,7 +164,7 @@ class Response:
         else:
             t["result"] = self.payload.to_jsonable_type()
 
-        return json.dumps(t)
+        return t
 
 
 def parse_response(obj) -> Response:
@@ -178,38 +208,157 @@ class NoSuchRequest(JsonRpcError):
         super().__init__(code=402, message=self.message, data=data)
 
 
-T = TypeVar("T")
+# Error: the parameters don't fit the signature of the requested method
+class InvalidParamsError(JsonRpcError):
+    message = "invalid parameters"
+
+    def __init__(self, data):
+        super().__init__(code=422, message=self.message, data=data)
+
+
+# Error: the server as a whole is handling as many requests as it is willing
+# to; try again later
+class BusyError(JsonRpcError):
+    message = "server busy"
+
+    def __init__(self):
+        super().__init__(code=503, message=self.message, data=[])
 
 
-# An [Ivar] is a write-once, concurrent [ref]. Initially, when an ivar is
-# created it is "empty", and attempting to [read] from it will block until it
-# is [fill]ed from another job.
-# XXX: This probably shouldn't live here.
-# asyncio sucks for not having this builtin
-class Ivar(Generic[T]):
-    ev: asyncio.Event
-    t: T
+# Error: the handler failed with something other than a [JsonRpcError]
+class InternalError(JsonRpcError):
+    message = "internal error"
 
     def __init__(self):
-        self.ev = asyncio.Event()
-        # We explicitly do not set [self.t] here; it should be set by [fill]
-        # only.
-
-    async def read(self) -> T:
-        await self.ev.wait()
-        return self.t
-
-    def fill(self, val: T):
-        self.t = val
-        self.ev.set()
-
-    # This is technically wrong -- if [T] is itself an [Optional], the caller
-    # can't distinguish "unfilled" from "filled with None". However, as this is
-    # not a general-purpose library, whatever.
-    def peek(self) -> Optional[T]:
-        if self.ev.is_set():
-            return self.t
+        super().__init__(code=500, message=self.message, data=[])
+
+
+# Error: the peer asked to switch to an encoding we can't speak
+class UnsupportedEncoding(JsonRpcError):
+    message = "unsupported encoding"
+
+    def __init__(self, name):
+        super().__init__(code=415, message=self.message, data=name)
+
+
+# Built-in method used by [Session.negotiate_encoding]. Method names starting
+# with "rpc." are reserved for this sort of thing by the JSON-RPC spec.
+ENCODING_METHOD = "rpc.encoding"
+
+
+T = TypeVar("T")
+
+
+# Types that a decoded parameter can actually have, and that are therefore
+# worth checking for
+JSON_TYPES = (str, int, float, bool, list, dict, type(None))
+
+
+# Helper: turn a parameter annotation into a tuple of classes to check decoded
+# values against with [isinstance], or None if it's not something we can check
+# cheaply (e.g. a [Jsonable] wrapper, or no annotation at all).
+def checkable_types(annotation: Any) -> Optional[tuple[type, ...]]:
+    # NewTypes like [common.User] are checked as their underlying type
+    while hasattr(annotation, "__supertype__"):
+        annotation = annotation.__supertype__
+    if typing.get_origin(annotation) is Union:
+        result: tuple[type, ...] = ()
+        for arg in typing.get_args(annotation):
+            types = checkable_types(arg)
+            if types is None:
+                return None
+            result += types
+        return result
+    # [list[str]] is checked as [list], etc.
+    annotation = typing.get_origin(annotation) or annotation
+    if annotation not in JSON_TYPES:
         return None
+    # JSON doesn't distinguish integral floats from ints
+    if annotation is float:
+        return (float, int)
+    return (annotation,)
+
+
+# Process-wide count of handlers running in the background, across every
+# session. Once [limit] is reached, new requests are turned away with
+# [BusyError] instead of being started.
+class JobLimit:
+    limit: Optional[int]
+    in_use: int
+
+    def __init__(self, limit=None):
+        self.limit = limit
+        self.in_use = 0
+
+    def reserve(self) -> bool:
+        if self.limit is not None and self.in_use >= self.limit:
+            return False
+        self.in_use += 1
+        return True
+
+    def release(self) -> None:
+        self.in_use -= 1
+
+
+# Shared by every session; set [GLOBAL_JOBS.limit] to configure.
+GLOBAL_JOBS = JobLimit()
+
+
+# A registered method, along with what we learned about its signature when it
+# was registered, so that each call can be checked without re-inspecting it
+class Handler:
+    # Either a coroutine function, or (if [inline]) a plain function, which
+    # is called directly from the event loop with no task of its own. Inline
+    # handlers must therefore be cheap and must not block.
+    action: Callable[..., Any]
+    inline: bool
+    min_args: int
+    # None if the method takes [*args]
+    max_args: Optional[int]
+    # per positional parameter, the types its argument must have (if known)
+    param_types: list[Optional[tuple[type, ...]]]
+
+    def __init__(self, action, inline=False):
+        if inline and inspect.iscoroutinefunction(action):
+            raise ValueError("inline handlers must be plain functions")
+        self.action = action
+        self.inline = inline
+        self.min_args = 0
+        self.max_args = 0
+        self.param_types = []
+
+        try:
+            sig = inspect.signature(action)
+        except (TypeError, ValueError):
+            # can't introspect (e.g. some builtins); accept anything
+            self.max_args = None
+            return
+        try:
+            hints = typing.get_type_hints(action)
+        except Exception:
+            # unresolvable forward references; skip type checks
+            hints = {}
+
+        for param in sig.parameters.values():
+            if param.kind == param.VAR_POSITIONAL:
+                self.max_args = None
+            elif param.kind in (param.POSITIONAL_ONLY, param.POSITIONAL_OR_KEYWORD):
+                if param.default is param.empty:
+                    self.min_args += 1
+                if self.max_args is not None:
+                    self.max_args += 1
+                self.param_types.append(checkable_types(hints.get(param.name)))
+
+    # Raise [InvalidParamsError] unless [params] can be passed to the method
+    def check(self, params: Any) -> None:
+        if not isinstance(params, list):
+            raise InvalidParamsError("params must be a list")
+        n = len(params)
+        if n < self.min_args or (self.max_args is not None and n > self.max_args):
+            raise InvalidParamsError(f"wrong number of params: {n}")
+        for i, (param, types) in enumerate(zip(params, self.param_types)):
+            if types is not None and not isinstance(param, types):
+                raise InvalidParamsError(f"param {i} has wrong type")
 
 
 # This class is a jsonrpc layer over transport session
@@ -219,80 +368,260 @@ class Session:
     # In python 3.11, we can use [asyncio.TaskGroup] for this. However, we will
     # do the bookkeeping ourselves for this assignment for ease of portability.
     pending_jobs: set[asyncio.Task]
-    pending_requests: dict[RequestId, Ivar[Response]]
-    handlers: dict[str, Callable[..., Coroutine[None, None, Jsonable]]]
+    # Requests we have sent and are waiting on a response for. When the
+    # session ends, any that remain fail with [Disconnected].
+    pending_requests: dict[RequestId, asyncio.Future[Response]]
+    # How long [request] waits for a response by default, in seconds (None
+    # means forever)
+    default_timeout: Optional[float]
+    handlers: dict[str, Handler]
+    # At most [max_jobs] (non-inline) handlers run at once; past that, we stop
+    # reading requests until one finishes, so that a client sending requests
+    # faster than we handle them is slowed down by TCP flow control. None
+    # means no limit. (There is also a limit across all sessions; see
+    # [GLOBAL_JOBS].)
+    max_jobs: Optional[int]
+    active_handlers: int
+    handler_finished: asyncio.Event
     is_running: bool
+    # How payloads are converted to and from bytes. We always send with
+    # [codec]. Incoming JSON payloads are decoded with [json_codec], and once
+    # a binary encoding has been negotiated, anything else with
+    # [binary_codec].
+    codec: serde.Codec
+    json_codec: serde.Codec
+    binary_codec: Optional[serde.Codec]
+    # Where calls on this session, handled and sent, are recorded
+    metrics: metrics.Registry
 
     # Initialize session
-    def __init__(self, session):
+    def __init__(
+        self,
+        session,
+        codec: Optional[serde.Codec] = None,
+        timeout: Optional[float] = None,
+        max_jobs: Optional[int] = None,
+    ):
         self.curr_id = RequestId(0)
         self.session = session
+        self.json_codec = serde.DEFAULT if codec is None else codec
+        self.codec = self.json_codec
+        self.binary_codec = None
         self.handlers = dict()
         self.pending_jobs = set()
         self.pending_requests = dict()
+        self.default_timeout = timeout
+        self.max_jobs = max_jobs
+        self.active_handlers = 0
+        self.handler_finished = asyncio.Event()
         self.is_running = False
+        self.metrics = metrics.REGISTRY
+        self.register_handler(ENCODING_METHOD, self.accept_encoding, inline=True)
 
+    # Register [action] as the handler for [method_name]. If [inline] is set,
+    # [action] must be a plain function; see [Handler.action].
     def register_handler(
         self,
         method_name: str,
-        action: Callable[..., Coroutine[None, None, Jsonable]],
+        action: Callable[..., Any],
+        *,
+        inline: bool = False,
     ):
-        self.handlers[method_name] = action
+        self.handlers[method_name] = Handler(action, inline)
 
     # Helper: Run a coroutine in the background
-    def run_in_background(self, coro: Coroutine[Any, Any, Any]):
+    def run_in_background(self, coro: Coroutine[Any, Any, Any]) -> asyncio.Task:
         task = asyncio.create_task(coro)
         self.pending_jobs.add(task)
         # discard this task from pending jobs when done
         task.add_done_callback(self.pending_jobs.discard)
+        return task
+
+    # Helper: Run a handler in the background, counting it against
+    # [max_jobs] and [GLOBAL_JOBS]. The caller must have reserved a slot in
+    # [GLOBAL_JOBS] already.
+    def run_handler_in_background(self, coro: Coroutine[Any, Any, Any]) -> None:
+        task = self.run_in_background(coro)
+        self.active_handlers += 1
+        task.add_done_callback(self.on_handler_finished)
+
+    def on_handler_finished(self, task: asyncio.Task) -> None:
+        self.active_handlers -= 1
+        GLOBAL_JOBS.release()
+        self.handler_finished.set()
+
+    # Wait until we're allowed to start another handler
+    async def wait_for_handler_slot(self) -> None:
+        while self.max_jobs is not None and self.active_handlers >= self.max_jobs:
+            self.handler_finished.clear()
+            await self.handler_finished.wait()
 
     # Send an error response and catch exception
     async def report_error_nofail(self, error: JsonRpcError) -> None:
         resp = Response(id=None, payload=error, is_error=True)
         try:
-            # send the message
-            await self.session.send(
-                # convert response to string and encode
-                resp.serialize().encode(encoding=transport.STRING_ENCODING)
-            )
+            # convert response to bytes and send
+            await self.session.send(resp.serialize(self.codec))
         except Exception:
             # in a real application, we would log here
             return
 
+    # Send an error response without waiting (or spawning a task to wait) for
+    # it to go out. Responses to notifications carry no ID.
+    def reply_error_nowait(self, req: Request, error: JsonRpcError) -> None:
+        resp = Response(id=req.id, payload=error, is_error=True)
+        self.session.send_nowait(resp.serialize(self.codec))
+
     # Helper: Handle client request and send response
-    async def handle_and_respond(self, req: Request) -> None:
-        # if no such requested method, send error
-        if req.method not in self.handlers:
-            await self.report_error_nofail(NoSuchEndpointError(req.method))
+    async def handle_and_respond(self, handler: Handler, req: Request) -> None:
+        resp = await self.call_handler(handler, req)
+
+        # Notifications do not expect a response
+        if req.is_notification():
             return
+
+        # convert response to bytes and send
+        await self.session.send(resp.serialize(self.codec))
+
+    # Helper: Find the handler for a request and check the request's params
+    # against it, raising the appropriate error if either fails
+    def lookup(self, req: Request) -> Handler:
+        handler = self.handlers.get(req.method)
+        if handler is None:
+            raise NoSuchEndpointError(req.method)
+        handler.check(req.params)
+        return handler
+
+    # Helper: Look up and check the handler for a request, then call it and
+    # wrap up the result (or error) as a response
+    async def run_handler(self, req: Request) -> Response:
+        try:
+            handler = self.lookup(req)
+        except JsonRpcError as e:
+            return Response(id=req.id, payload=e, is_error=True)
+        return await self.call_handler(handler, req)
+
+    # Helper: Call an already-checked handler and wrap up the result (or
+    # error) as a response
+    async def call_handler(self, handler: Handler, req: Request) -> Response:
+        if handler.inline:
+            return self.call_inline(handler, req)
+        stats = self.metrics.inbound(req.method)
+        started = stats.start()
+        success = False
         try:
             # attempt to call method with params and get result
-            result = await self.handlers[req.method](*req.params)
+            result = await handler.action(*req.params)
             success = True
         except JsonRpcError as e:
             # if get an error, we will return this
             result = e
-            success = False
+        except Exception:
+            # in a real application, we would log here
+            result = InternalError()
+        finally:
+            stats.finish(started, not success)
 
+        # This [id=req.id] is a bit cheeky. The meaning of [None] in [req.id]
+        # is different from [None] in [resp.id], but callers won't send the
+        # response to a notification anyway.
+        return Response(id=req.id, payload=result, is_error=not success)
+
+    # Helper: Call an already-checked inline handler and wrap up the result
+    # (or error) as a response
+    def call_inline(self, handler: Handler, req: Request) -> Response:
+        stats = self.metrics.inbound(req.method)
+        started = stats.start()
+        success = False
+        try:
+            result = handler.action(*req.params)
+            success = True
+        except JsonRpcError as e:
+            result = e
+        except Exception:
+            # in a real application, we would log here
+            result = InternalError()
+        finally:
+            stats.finish(started, not success)
+        return Response(id=req.id, payload=result, is_error=not success)
+
+    # Helper: Handle a batch of requests concurrently and send all the
+    # responses back as a single array. [errors] holds responses for elements
+    # of the batch that weren't valid requests in the first place.
+    async def handle_batch(self, reqs: list[Request], errors: list[Response]) -> None:
+        resps = await asyncio.gather(*(self.run_handler(req) for req in reqs))
         # Notifications do not expect a response
-        if req.is_notification():
+        out = [
+            resp.to_jsonable_type()
+            for req, resp in zip(reqs, resps)
+            if not req.is_notification()
+        ]
+        out.extend(error.to_jsonable_type() for error in errors)
+        # a batch of nothing but notifications gets no response at all
+        if len(out) == 0:
             return
+        await self.session.send(self.codec.dumps(out))
 
-        # This [id=req.id] is a bit cheeky. The meaning of [None] in [req.id]
-        # is different from [None] in [resp.id], but we know that [req.id]
-        # isn't None because of the [req.is_notification] guard above, so we
-        # can just satisfy the typechecker without unwrapping.
-        resp = Response(id=req.id, payload=result, is_error=not success)
-
-        # send the message
-        await self.session.send(
-            # convert response to string and encode
-            resp.serialize().encode(encoding=transport.STRING_ENCODING)
-        )
-
-    # This is the function server uses to handle client requests
+    # This is the function server uses to handle client requests. Requests
+    # for unknown methods, or with params that don't fit the method, are
+    # rejected here, before any task is spawned for them.
     def handle(self, req: Request) -> None:
-        self.run_in_background(self.handle_and_respond(req))
+        try:
+            handler = self.lookup(req)
+        except JsonRpcError as e:
+            self.reply_error_nowait(req, e)
+            return
+
+        # fast path: cheap handlers are run right here, and their response is
+        # queued without waiting for it to be written
+        if handler.inline:
+            resp = self.call_inline(handler, req)
+            if not req.is_notification():
+                self.session.send_nowait(resp.serialize(self.codec))
+            return
+
+        if not GLOBAL_JOBS.reserve():
+            self.reply_error_nowait(req, BusyError())
+            return
+        self.run_handler_in_background(self.handle_and_respond(handler, req))
+
+    # Handler for [ENCODING_METHOD]: switch to the requested binary encoding.
+    # From here on we send with it, including the response to this request,
+    # which the peer is prepared to decode (see [negotiate_encoding]).
+    def accept_encoding(self, name: str) -> Ok:
+        codec = serde.CODECS.get(name)
+        if codec is None or not codec.binary:
+            raise UnsupportedEncoding(name)
+        self.binary_codec = codec
+        self.codec = codec
+        return Ok()
+
+    # Ask the peer to switch this connection to the first of [names] (e.g.
+    # "msgpack", "cbor") that both sides support, and return the one chosen
+    # (or None, in which case we carry on with JSON). The event loop must be
+    # running.
+    async def negotiate_encoding(self, *names: str) -> Optional[str]:
+        for name in names:
+            codec = serde.CODECS.get(name)
+            if codec is None or not codec.binary:
+                continue
+            # the peer answers in the new encoding if it accepts, so we have
+            # to be able to decode it before asking
+            self.binary_codec = codec
+            resp = await self.request(method=ENCODING_METHOD, params=[name])
+            if not resp.is_error:
+                self.codec = codec
+                return name
+        self.binary_codec = None
+        return None
+
+    # Decode an incoming payload, which may be JSON even after we have
+    # switched to a binary encoding (the peer may have sent it before
+    # switching)
+    def decode(self, payload: bytes) -> Any:
+        if self.binary_codec is not None and not serde.is_json(payload):
+            return self.binary_codec.loads(payload)
+        return self.json_codec.loads(payload)
 
     # Calculate fresh request ID for this session
     def fresh_id(self) -> RequestId:
@@ -300,86 +629,323 @@ class Session:
         self.curr_id = increment_requestid(self.curr_id)
         return prev
 
-    # This is the function used to send requests
-    async def request(self, *, method, params, is_notification=False) -> Response:  # type: ignore[return]
+    # Number of requests still waiting on a response
+    @property
+    def outstanding_requests(self) -> int:
+        return len(self.pending_requests)
+
+    # Helper: register a pending request and return the future that will
+    # receive its response
+    def expect_response(self, id: RequestId) -> "asyncio.Future[Response]":
+        fut = asyncio.get_running_loop().create_future()
+        self.pending_requests[id] = fut
+        return fut
+
+    # Helper: send [payload] and wait for [result], giving up with
+    # [asyncio.TimeoutError] after [timeout] seconds (or the session default)
+    async def send_and_wait(
+        self, payload: bytes, result: Awaitable[T], timeout: Optional[float]
+    ) -> T:
+        async def go() -> T:
+            await self.session.send(payload)
+            return await result
+
+        if timeout is None:
+            timeout = self.default_timeout
+        if timeout is None:
+            return await go()
+        return await asyncio.wait_for(go(), timeout)
+
+    # Send a notification that has already been serialized (possibly for
+    # another session, if it uses the same codec)
+    async def notify(self, note: PreparedNotification) -> None:
         # yield to scheduler to let [self.is_running] update
         await asyncio.sleep(0)
         if not self.is_running:
             raise Disconnected()
+        await self.session.send(note.serialize(self.codec))
 
-        # if notification, no response expected
-        if is_notification:
-            wait_for_resp = False
-            id = None
-        else:
-            # if will be expecting response, mark request as pending
-            wait_for_resp = True
-            id = self.fresh_id()
-            result_box: Ivar[Response] = Ivar()
-            self.pending_requests[id] = result_box
+    # This is the function used to send requests. Notifications, which get no
+    # response, are sent with [notify] or [notify_nowait] instead.
+    async def request(self, *, method, params, timeout=None) -> Response:
+        # yield to scheduler to let [self.is_running] update
+        await asyncio.sleep(0)
+        if not self.is_running:
+            raise Disconnected()
 
-        # create the request, convert it to string, encode, and send
+        # mark request as pending
+        id = self.fresh_id()
+        result = self.expect_response(id)
+
+        # create the request, convert it to bytes, send, and wait for the
+        # response. Whatever happens, the request is no longer pending after.
         req = Request(method=method, params=params, id=id)
-        await self.session.send(req.serialize().encode(transport.STRING_ENCODING))
+        stats = self.metrics.outbound(method)
+        started = stats.start()
+        failed = True
+        try:
+            resp = await self.send_and_wait(req.serialize(self.codec), result, timeout)
+            failed = resp.is_error
+            return resp
+        finally:
+            stats.finish(started, failed)
+            self.pending_requests.pop(id, None)
+
+    # Send a request without waiting for it to be written, or for any earlier
+    # request to be answered, and return a future for its response. Requests
+    # made this way are sent as [ordered] transport messages, so they arrive
+    # in the order they were made even when large ones are interleaved with
+    # others, and a peer that handles them in order (e.g. with [inline]
+    # handlers) sees them in that order too.
+    # The future fails with [asyncio.TimeoutError] after [timeout] seconds (or
+    # the session default), or [Disconnected] if the session ends first. To
+    # bound how many are outstanding at once, see [RequestWindow].
+    def request_nowait(
+        self, *, method, params, timeout: Optional[float] = None
+    ) -> "asyncio.Future[Response]":
+        if not self.is_running:
+            raise Disconnected()
+
+        id = self.fresh_id()
+        req = Request(method=method, params=params, id=id)
+        payload = req.serialize(self.codec)
+        result = self.expect_response(id)
+
+        stats = self.metrics.outbound(method)
+        started = stats.start()
+        if timeout is None:
+            timeout = self.default_timeout
+        timer = None
+        if timeout is not None:
+            loop = asyncio.get_running_loop()
+            timer = loop.call_later(timeout, self.expire_request, id)
+
+        def on_done(fut: "asyncio.Future[Response]") -> None:
+            self.pending_requests.pop(id, None)
+            if timer is not None:
+                timer.cancel()
+            # (retrieving the exception also keeps asyncio from complaining
+            # about it if the caller never looks at the future)
+            failed = fut.cancelled() or fut.exception() is not None
+            stats.finish(started, failed or fut.result().is_error)
+
+        result.add_done_callback(on_done)
+        self.session.send_nowait(payload, ordered=True)
+        return result
+
+    # Send a notification without waiting for it to be written. These are
+    # ordered together with [request_nowait]'s requests.
+    def notify_nowait(self, *, method, params) -> None:
+        if not self.is_running:
+            raise Disconnected()
+        req = Request(method=method, params=params, id=None)
+        self.session.send_nowait(req.serialize(self.codec), ordered=True)
+
+    # Helper: fail the pending request [id] with [asyncio.TimeoutError]
+    def expire_request(self, id: RequestId) -> None:
+        result = self.pending_requests.pop(id, None)
+        if result is not None and not result.done():
+            result.set_exception(asyncio.TimeoutError())
+
+    # Send several requests in a single message and wait for all of their
+    # responses, which are returned in the same order as [calls]. Each call is
+    # a pair of method name and parameter list. The peer runs the calls
+    # concurrently, so they should not depend on each other.
+    async def request_batch(
+        self, calls: list[tuple[str, list[Any]]], timeout: Optional[float] = None
+    ) -> list[Response]:
+        # yield to scheduler to let [self.is_running] update
+        await asyncio.sleep(0)
+        if not self.is_running:
+            raise Disconnected()
 
-        # wait for response, read it, and delete pending request
-        if wait_for_resp:
-            result = await result_box.read()
-            # included only to make mypy accept that [wait_for_resp] implies
-            # [id is not None]
-            assert id is not None
-            del self.pending_requests[id]
-            return result
+        if len(calls) == 0:
+            return []
+
+        # mark every request in the batch as pending
+        reqs = []
+        results = []
+        for method, params in calls:
+            id = self.fresh_id()
+            results.append(self.expect_response(id))
+            reqs.append(Request(method=method, params=params, id=id))
+
+        # convert the whole batch to bytes, send, and wait for the responses
+        payload = self.codec.dumps([req.to_jsonable_type() for req in reqs])
+        # each call in the batch is recorded as taking as long as the batch
+        stats = [self.metrics.outbound(method) for method, _ in calls]
+        started = [s.start() for s in stats]
+        resps: Optional[list[Response]] = None
+        try:
+            resps = await self.send_and_wait(payload, asyncio.gather(*results), timeout)
+            return resps
+        finally:
+            for i, s in enumerate(stats):
+                s.finish(started[i], resps is None or resps[i].is_error)
+            for req in reqs:
+                assert req.id is not None
+                self.pending_requests.pop(req.id, None)
+
+    # Fail every outstanding request at once, e.g. because the peer is gone
+    def fail_pending_requests(self, error: Exception) -> None:
+        for result in self.pending_requests.values():
+            if not result.done():
+                result.set_exception(error)
+        self.pending_requests.clear()
+
+    # Close the connection. The event loop stops soon after; we mark the
+    # session as not running right away so that nothing else is sent.
+    def close(self) -> None:
+        self.is_running = False
+        self.session.writer.close()
+        self.fail_pending_requests(Disconnected())
+
+    # Handle a single (non-batch) incoming message
+    def receive(self, obj: Any) -> None:
+        if isinstance(obj, dict):
+            # if there's a field for method, it's a client request
+            if "method" in obj:
+                try:
+                    req = parse_request(obj)
+                    self.handle(req)
+                except (ValueError, TypeError):
+                    self.run_in_background(
+                        self.report_error_nofail(BadRequestError(obj))
+                    )
+            # otherwise, if there's a field for id,
+            # it's a response to a request
+            elif "id" in obj:
+                try:
+                    resp = parse_response(obj)
+                except (ValueError, TypeError):
+                    self.run_in_background(
+                        self.report_error_nofail(BadRequestError(obj))
+                    )
+                else:
+                    if resp.id is None:
+                        # in a real app: log
+                        return
+                    result = self.pending_requests.get(resp.id)
+                    if result is None:
+                        self.run_in_background(
+                            self.report_error_nofail(NoSuchRequest(obj))
+                        )
+                        return
+                    if not result.done():
+                        result.set_result(resp)
+            else:
+                self.run_in_background(self.report_error_nofail(BadRequestError(obj)))
+        else:
+            self.run_in_background(self.report_error_nofail(BadRequestError(obj)))
+
+    # Handle an incoming batch: either requests, which are handed off to
+    # [handle_batch], or responses to one of our own batches
+    def receive_batch(self, objs: list[Any]) -> None:
+        if len(objs) == 0:
+            self.run_in_background(self.report_error_nofail(BadRequestError(objs)))
+            return
+
+        reqs = []
+        errors = []
+        for obj in objs:
+            if isinstance(obj, dict) and "method" in obj:
+                try:
+                    reqs.append(parse_request(obj))
+                except (ValueError, TypeError):
+                    errors.append(
+                        Response(id=None, payload=BadRequestError(obj), is_error=True)
+                    )
+            elif isinstance(obj, dict) and "id" in obj:
+                self.receive(obj)
+            else:
+                errors.append(
+                    Response(id=None, payload=BadRequestError(obj), is_error=True)
+                )
+
+        if len(reqs) == 0 and len(errors) == 0:
+            return
+        if not GLOBAL_JOBS.reserve():
+            # the whole batch is turned away
+            for req in reqs:
+                if not req.is_notification():
+                    errors.append(
+                        Response(id=req.id, payload=BusyError(), is_error=True)
+                    )
+            if len(errors) > 0:
+                payload = [error.to_jsonable_type() for error in errors]
+                self.session.send_nowait(self.codec.dumps(payload))
+            return
+        self.run_handler_in_background(self.handle_batch(reqs, errors))
 
     # Loop to handle all events: client requests and server responses
     async def run_event_loop(self) -> None:
         self.is_running = True
         # use the transport session iterator to receive messages
         async for payload in self.session:
-            obj = json.loads(payload)
-            if isinstance(obj, dict):
-                # if there's a field for method, it's a client request
-                if "method" in obj:
-                    try:
-                        req = parse_request(obj)
-                        self.handle(req)
-                    except (ValueError, TypeError):
-                        self.run_in_background(
-                            self.report_error_nofail(BadRequestError(obj))
-                        )
-                # otherwise, if there's a field for id,
-                # it's a response to a request
-                elif "id" in obj:
-                    try:
-                        resp = parse_response(obj)
-                    except (ValueError, TypeError):
-                        self.run_in_background(
-                            self.report_error_nofail(BadRequestError(obj))
-                        )
-                    else:
-                        if resp.id is None:
-                            # in a real app: log
-                            continue
-                        if resp.id not in self.pending_requests:
-                            self.run_in_background(
-                                self.report_error_nofail(NoSuchRequest(obj))
-                            )
-                            continue
-                        self.pending_requests[resp.id].fill(resp)
-                else:
-                    self.run_in_background(
-                        self.report_error_nofail(BadRequestError(obj))
-                    )
+            try:
+                obj = self.decode(payload)
+            except serde.DecodeError:
+                self.run_in_background(self.report_error_nofail(BadRequestError(None)))
+                continue
+            if isinstance(obj, list):
+                self.receive_batch(obj)
             else:
-                self.run_in_background(self.report_error_nofail(BadRequestError(obj)))
+                self.receive(obj)
+            # don't read any further while we're at the handler limit
+            await self.wait_for_handler_slot()
 
         self.is_running = False
 
+        self.fail_pending_requests(Disconnected())
+
         for job in list(self.pending_jobs):
             job.cancel()
 
 
-# create a session
-def spawn_session(reader, writer) -> Session:
-    sess = transport.Session(reader, writer)
-    return Session(sess)
+# Pipelines requests on [session] (see [Session.request_nowait]) while keeping
+# at most [size] of them outstanding: [submit] waits for an earlier request to
+# be answered once the window is full.
+class RequestWindow:
+    session: Session
+    slots: asyncio.Semaphore
+    outstanding: set["asyncio.Future[Response]"]
+
+    def __init__(self, session: Session, size: int):
+        self.session = session
+        self.slots = asyncio.Semaphore(size)
+        self.outstanding = set()
+
+    # Send a request once there is room in the window, and return a future for
+    # its response
+    async def submit(
+        self, *, method, params, timeout: Optional[float] = None
+    ) -> "asyncio.Future[Response]":
+        await self.slots.acquire()
+        try:
+            result = self.session.request_nowait(
+                method=method, params=params, timeout=timeout
+            )
+        except BaseException:
+            self.slots.release()
+            raise
+        self.outstanding.add(result)
+        result.add_done_callback(self.on_done)
+        return result
+
+    def on_done(self, result: "asyncio.Future[Response]") -> None:
+        self.outstanding.discard(result)
+        self.slots.release()
+
+    # Wait until every request submitted so far has been answered (or failed)
+    async def drain(self) -> None:
+        if len(self.outstanding) > 0:
+            await asyncio.wait(list(self.outstanding))
+
+
+# create a session; other keyword arguments are passed on to
+# [transport.Session]
+def spawn_session(
+    reader, writer, *, codec=None, timeout=None, max_jobs=None, **kwargs
+) -> Session:
+    sess = transport.Session(reader, writer, **kwargs)
+    return Session(sess, codec, timeout, max_jobs)
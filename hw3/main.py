@@ -2,8 +2,28 @@ import asyncio
 import client
 import server
 import argparse
+import config
 import filelib
 
+# Event loop implementations [--loop] accepts. "auto" means uvloop if it is
+# installed, and asyncio's own loop otherwise.
+LOOPS = ("auto", "asyncio", "uvloop")
+
+
+# Make [asyncio.run] use the event loop named by [loop], and return the name
+# of the one actually installed
+def install_loop(loop: str) -> str:
+    if loop == "asyncio":
+        return "asyncio"
+    try:
+        import uvloop  # type: ignore
+    except ImportError:
+        if loop == "uvloop":
+            print("uvloop is not installed; falling back to the asyncio event loop")
+        return "asyncio"
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    return "uvloop"
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
@@ -12,8 +32,11 @@ if __name__ == "__main__":
     parser.add_argument("command", choices=["client", "server"])
     parser.add_argument("host")
     parser.add_argument("port")
+    # defaults to the [loop] setting in config.json
+    parser.add_argument("--loop", choices=LOOPS, default=None)
 
     args = parser.parse_args()
+    install_loop(args.loop if args.loop is not None else config.load().loop)
 
     if args.command == "server":
         asyncio.run(server.main(args.host, int(args.port)))
@@ -0,0 +1,161 @@
+# Lightweight instrumentation for the JSON-RPC layer: per-method call and
+# error counts, in-flight gauges, and latency histograms, for both the
+# requests we handle and the ones we send. [jsonrpc.Session] records into
+# [REGISTRY] by default; the server exposes it via the [stats] method and
+# [dump_periodically].
+
+import asyncio
+import json
+import time
+from typing import Any, Optional
+
+# Latencies are recorded in whole microseconds
+US_PER_SECOND = 1_000_000
+
+# Each power of two is split into [1 << PRECISION_BITS] equal buckets, so any
+# recorded value is off by at most 1/16th (~6%). This is the same scheme as
+# HdrHistogram, minus the configurable range: buckets are added on demand.
+PRECISION_BITS = 4
+SUB_BUCKETS = 1 << PRECISION_BITS
+
+
+def bucket_index(value: int) -> int:
+    if value < SUB_BUCKETS:
+        return value
+    # keep the top [PRECISION_BITS + 1] bits of the value
+    shift = value.bit_length() - PRECISION_BITS - 1
+    return (shift + 1) * SUB_BUCKETS + (value >> shift) - SUB_BUCKETS
+
+
+# The smallest value that falls into bucket [idx]
+def bucket_floor(idx: int) -> int:
+    if idx < SUB_BUCKETS:
+        return idx
+    shift = idx // SUB_BUCKETS - 1
+    return (idx % SUB_BUCKETS + SUB_BUCKETS) << shift
+
+
+class Histogram:
+    counts: list[int]
+    count: int
+    total: int
+    max: int
+
+    def __init__(self):
+        self.counts = []
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def record(self, value: int) -> None:
+        idx = bucket_index(value)
+        if idx >= len(self.counts):
+            self.counts.extend([0] * (idx + 1 - len(self.counts)))
+        self.counts[idx] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    # The (approximate) value below which a fraction [q] of recorded values
+    # fall
+    def percentile(self, q: float) -> int:
+        if self.count == 0:
+            return 0
+        target = q * self.count
+        seen = 0
+        for idx, n in enumerate(self.counts):
+            seen += n
+            if seen >= target and n > 0:
+                return min(bucket_floor(idx), self.max)
+        return self.max
+
+    def to_jsonable_type(self) -> Any:
+        return {
+            "count": self.count,
+            "mean_us": self.total // self.count if self.count else 0,
+            "p50_us": self.percentile(0.5),
+            "p90_us": self.percentile(0.9),
+            "p99_us": self.percentile(0.99),
+            "max_us": self.max,
+        }
+
+
+class MethodStats:
+    calls: int
+    errors: int
+    in_flight: int
+    latency: Histogram
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.in_flight = 0
+        self.latency = Histogram()
+
+    # Mark a call as started, returning the start time to pass to [finish]
+    def start(self) -> float:
+        self.in_flight += 1
+        return time.perf_counter()
+
+    def finish(self, started: float, is_error: bool) -> None:
+        elapsed = time.perf_counter() - started
+        self.in_flight -= 1
+        self.calls += 1
+        if is_error:
+            self.errors += 1
+        self.latency.record(int(elapsed * US_PER_SECOND))
+
+    def to_jsonable_type(self) -> Any:
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "in_flight": self.in_flight,
+            "latency": self.latency.to_jsonable_type(),
+        }
+
+
+# Per-method stats for handled ([inbound]) and sent ([outbound]) requests
+class Registry:
+    inbound_methods: dict[str, MethodStats]
+    outbound_methods: dict[str, MethodStats]
+
+    def __init__(self):
+        self.inbound_methods = dict()
+        self.outbound_methods = dict()
+
+    def inbound(self, method: str) -> MethodStats:
+        stats = self.inbound_methods.get(method)
+        if stats is None:
+            stats = self.inbound_methods[method] = MethodStats()
+        return stats
+
+    def outbound(self, method: str) -> MethodStats:
+        stats = self.outbound_methods.get(method)
+        if stats is None:
+            stats = self.outbound_methods[method] = MethodStats()
+        return stats
+
+    def to_jsonable_type(self) -> Any:
+        return {
+            "inbound": {
+                method: stats.to_jsonable_type()
+                for method, stats in self.inbound_methods.items()
+            },
+            "outbound": {
+                method: stats.to_jsonable_type()
+                for method, stats in self.outbound_methods.items()
+            },
+        }
+
+
+REGISTRY = Registry()
+
+
+# Print the contents of [registry] every [interval] seconds, forever
+async def dump_periodically(interval: float, registry: Optional[Registry] = None):
+    if registry is None:
+        registry = REGISTRY
+    while True:
+        await asyncio.sleep(interval)
+        print("stats:", json.dumps(registry.to_jsonable_type()))
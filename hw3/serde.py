@@ -0,0 +1,163 @@
+# Pluggable serialization for the JSON-RPC layer.
+#
+# Every codec turns jsonable values straight into [bytes] (and back), so the
+# RPC layer never has to build an intermediate [str] and then encode it. The
+# fastest JSON library that is installed is picked as [DEFAULT]; orjson and
+# ujson are optional, and we fall back to the standard library without them.
+#
+# Sessions may also switch to a binary encoding (MessagePack or CBOR, if the
+# respective library is installed) carrying the same values; see
+# [jsonrpc.Session.negotiate_encoding]. A JSON-RPC message is always an object
+# or an array, and no binary encoding of those starts with a byte that JSON
+# may start with, so a receiver can tell JSON payloads apart by [is_json].
+
+import json
+from typing import Any, Optional
+
+try:
+    import orjson  # type: ignore
+except ImportError:
+    orjson = None  # type: ignore
+
+try:
+    import ujson  # type: ignore
+except ImportError:
+    ujson = None
+
+try:
+    import msgpack  # type: ignore
+except ImportError:
+    msgpack = None
+
+try:
+    import cbor2  # type: ignore
+except ImportError:
+    cbor2 = None
+
+import transport
+
+
+# Called by the encoders on objects they don't know how to serialize. This
+# lets [jsonrpc.Jsonable] wrappers appear anywhere inside a payload, rather
+# than requiring callers to convert them up front.
+def to_jsonable(obj: Any) -> Any:
+    if hasattr(obj, "to_jsonable_type"):
+        return obj.to_jsonable_type()
+    raise TypeError(f"{type(obj).__name__} is not serializable")
+
+
+# Raised by [Codec.loads] on malformed input, whatever library is in use
+class DecodeError(ValueError):
+    pass
+
+
+class Codec:
+    name: str
+    # is this a binary (non-JSON) encoding?
+    binary = False
+
+    def dumps(self, obj: Any) -> bytes:
+        raise NotImplementedError
+
+    def loads(self, data: bytes) -> Any:
+        raise NotImplementedError
+
+
+class StdlibJson(Codec):
+    name = "json"
+
+    def dumps(self, obj: Any) -> bytes:
+        s = json.dumps(obj, separators=(",", ":"), default=to_jsonable)
+        return s.encode(transport.STRING_ENCODING)
+
+    def loads(self, data: bytes) -> Any:
+        try:
+            return json.loads(data)
+        except (ValueError, UnicodeDecodeError) as e:
+            raise DecodeError(str(e)) from e
+
+
+class OrJson(Codec):
+    name = "orjson"
+
+    def dumps(self, obj: Any) -> bytes:
+        # orjson would otherwise serialize dataclasses field by field, rather
+        # than through their [to_jsonable_type]
+        option = orjson.OPT_PASSTHROUGH_DATACLASS
+        return orjson.dumps(obj, default=to_jsonable, option=option)
+
+    def loads(self, data: bytes) -> Any:
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError as e:
+            raise DecodeError(str(e)) from e
+
+
+class UJson(Codec):
+    name = "ujson"
+
+    def dumps(self, obj: Any) -> bytes:
+        s = ujson.dumps(obj, default=to_jsonable, ensure_ascii=False)
+        return s.encode(transport.STRING_ENCODING)
+
+    def loads(self, data: bytes) -> Any:
+        try:
+            return ujson.loads(data)
+        except ValueError as e:
+            raise DecodeError(str(e)) from e
+
+
+class MsgPack(Codec):
+    name = "msgpack"
+    binary = True
+
+    def dumps(self, obj: Any) -> bytes:
+        return msgpack.packb(obj, default=to_jsonable, use_bin_type=True)
+
+    def loads(self, data: bytes) -> Any:
+        try:
+            return msgpack.unpackb(data, raw=False, strict_map_key=False)
+        except (ValueError, msgpack.UnpackException) as e:
+            raise DecodeError(str(e)) from e
+
+
+class Cbor(Codec):
+    name = "cbor"
+    binary = True
+
+    def dumps(self, obj: Any) -> bytes:
+        return cbor2.dumps(obj, default=lambda enc, v: enc.encode(to_jsonable(v)))
+
+    def loads(self, data: bytes) -> Any:
+        try:
+            return cbor2.loads(data)
+        except (ValueError, cbor2.CBORDecodeError) as e:
+            raise DecodeError(str(e)) from e
+
+
+# All available codecs by name, fastest JSON implementation first
+CODECS: dict[str, Codec] = {}
+if orjson is not None:
+    CODECS[OrJson.name] = OrJson()
+if ujson is not None:
+    CODECS[UJson.name] = UJson()
+CODECS[StdlibJson.name] = StdlibJson()
+if msgpack is not None:
+    CODECS[MsgPack.name] = MsgPack()
+if cbor2 is not None:
+    CODECS[Cbor.name] = Cbor()
+
+DEFAULT: Codec = next(iter(CODECS.values()))
+
+# Bytes a JSON document may start with: an object, an array, or whitespace
+JSON_START = frozenset(b"{[ \t\r\n")
+
+
+def is_json(data: bytes) -> bool:
+    return len(data) > 0 and data[0] in JSON_START
+
+
+def get(name: Optional[str] = None) -> Codec:
+    if name is None:
+        return DEFAULT
+    return CODECS[name]
@@ -2,25 +2,59 @@
 # lot of domain-level concerns with the details of replication, etc.
 
 import asyncio
-import json
+import collections
+import concurrent.futures
+import hmac
+import itertools
 from collections.abc import Coroutine
 from dataclasses import dataclass
-from typing import Optional, Callable, Awaitable, NoReturn, Any, Union
-import os.path
+from typing import Optional, Callable, Awaitable, NoReturn, Any
+import os
 
-from common import User, Ok, Host, Port, Address
+from common import User, Ok, Host, Port, Address, Disconnected
 import config
 import jsonrpc
-
-SERVER_DB_FORMAT = "{host}-{port}-db.json"
+import metrics
+import serde
+import transport
+
+# Directory where each server keeps its snapshot and log; see [Db]
+SERVER_DB_FORMAT = "{host}-{port}-db"
+# Names of the files in it
+SNAPSHOT_FILE = "snapshot"
+SEGMENT_FORMAT = "log.{:08d}"
+# Where servers used to keep their data, newest first: a single log file, and
+# before that, a JSON snapshot rewritten on every change. A server that finds
+# no [SERVER_DB_FORMAT] directory imports the first of these it finds; see
+# [Db.replay_legacy].
+LEGACY_DB_FORMATS = ("{host}-{port}-db.log", "{host}-{port}-db.json")
+
+# Codec used to compress large messages (full-db transfers, login backlogs)
+# on links whose peer supports it; see [transport.Session.negotiate].
+COMPRESSION = "zlib"
+# How many batches of log records may be waiting on the disk at once; see
+# [Db]
+MAX_QUEUED_BATCHES = 2
+# Binary payload encodings to try on replica links, in order of preference;
+# see [jsonrpc.Session.negotiate_encoding]. If none is installed on both ends,
+# we stay on JSON.
+BINARY_ENCODINGS = ("msgpack", "cbor")
+# How long (in seconds) to wait on a backup before giving up on it and moving
+# on to the next one in the chain
+REPLICA_TIMEOUT = 30.0
 
 pending_jobs: set[asyncio.Task] = set()
 
 
-async def ping() -> Ok:
+def ping() -> Ok:
     return Ok()
 
 
+# Per-method call counts, error counts and latencies for this server process
+def stats() -> metrics.Registry:
+    return metrics.REGISTRY
+
+
 @dataclass
 class Message:
     sender: User
@@ -97,6 +131,27 @@ class AlreadyLoggedInSession(jsonrpc.JsonRpcError):
         super().__init__(code=306, message=self.message, data={"current_user": s})
 
 
+class WrongShard(jsonrpc.JsonRpcError):
+    message = "user belongs to another shard"
+
+    def __init__(self, user, shard):
+        super().__init__(code=307, message=self.message, data=[user, shard])
+
+
+class StorageError(jsonrpc.JsonRpcError):
+    message = "couldn't save the change to disk"
+
+    def __init__(self, s):
+        super().__init__(code=507, message=self.message, data=s)
+
+
+class UnknownPeer(jsonrpc.JsonRpcError):
+    message = "not a server of another shard"
+
+    def __init__(self, host, port):
+        super().__init__(code=308, message=self.message, data=[host, port])
+
+
 class ImABackup(jsonrpc.JsonRpcError):
     message = "I am a backup, please connect to a primary server"
 
@@ -111,16 +166,42 @@ class ImPrimary(jsonrpc.JsonRpcError):
         super().__init__(code=501, message=self.message, data=[])
 
 
+class ShardUnavailable(jsonrpc.JsonRpcError):
+    message = "no server in the recipient's shard is reachable"
+
+    def __init__(self, shard):
+        super().__init__(code=502, message=self.message, data=shard)
+
+
+# How far along the replication log a server is; see [Db.seq]
 @dataclass
-class DbUpdate:
-    db: dict[User, MessageList]
-    mtime: Optional[float]
+class ReplicaPosition:
+    seq: int
 
     def to_jsonable_type(self):
-        return {
-            "db": {user: msgs.to_jsonable_type() for user, msgs in self.db.items()},
-            "mtime": self.mtime,
-        }
+        return self.seq
+
+
+# Log records after a given one, or None if they're no longer all available;
+# see [Db.records_since]
+@dataclass
+class RecordList:
+    data: Optional[list[dict[str, Any]]]
+
+    def to_jsonable_type(self):
+        return self.data
+
+
+# One piece of a snapshot of a whole database, as of record number [seq]
+@dataclass
+class SnapshotChunk:
+    seq: int
+    users: list[tuple[User, Any]]
+    # is this the last piece?
+    done: bool
+
+    def to_jsonable_type(self):
+        return {"seq": self.seq, "users": self.users, "done": self.done}
 
 
 # This class holds the details of any particular client connection (namely, the
@@ -164,11 +245,11 @@ class UserSession:
         return await self.message_handler(Message(self.username, recipient, text))
 
     async def receive_message(self, msg: Message) -> Ok:
-        await self.owner.request(
-            method="receive_message",
-            params=[msg.to_jsonable_type()],
-            is_notification=True,
-        )
+        # A message only ever has the one recipient, so there's nothing to
+        # share the serialized notification with; [PreparedNotification]
+        # only pays off when one message goes out on several sessions.
+        note = jsonrpc.PreparedNotification(method="receive_message", params=[msg])
+        await self.owner.notify(note)
         return Ok()
 
     def cleanup(self):
@@ -180,14 +261,221 @@ def wrap_message_lists(d: dict[User, list[Message]]):
     return {user: MessageList(messages) for user, messages in d.items()}
 
 
+def message_of_jsonable(m) -> Message:
+    return Message(m["sender"], m["recipient"], m["content"])
+
+
+# The database is kept in memory, and persisted as a log with one record per
+# mutation, so that the cost of a write doesn't grow with the size of the
+# database. Each record is a JSON object on a line of its own:
+#   {"op": "append", "user": ..., "msg": {...}, "seq": n}  message stored
+#   {"op": "set", "user": ..., "msgs": [...], "seq": n}    messages replaced
+#   {"op": "del", "user": ..., "seq": n}                   [user] deleted
+# Records are numbered consecutively; [seq] is that of the latest one. The
+# same records, with the same numbers, are what the chain replicates (see
+# [State.replicate]), so a backup's [seq] says exactly how far along it is.
+# The last [replication_log] of them are kept in [recent] for that purpose.
+#
+# To keep the log (and the time to replay it) from growing without bound, it
+# is split into numbered segments, next to a snapshot of the whole database:
+#   {"segment": n, "seq": n, "db": {...}}
+# which covers everything logged before segment [n]. [commit] takes a new
+# snapshot and starts a new segment; once the snapshot is safely in place, the
+# segments it covers are deleted. This happens whenever the current segment
+# outgrows both [compact_bytes] and the last snapshot (so replay never costs
+# much more than reading the database twice), and after a full transfer from
+# upstream. On startup, [replay] loads the snapshot and the segments after it.
+#
+# Records are written by group commit: those logged within [window] seconds of
+# each other (or until [max_batch] of them pile up) are written and fsync'd
+# together, so that one fsync covers many mutations. The in-memory state is
+# updated right away; await [sync] before acknowledging a mutation, to know
+# that it has reached the disk.
+#
+# All file I/O happens on a dedicated writer thread, so a slow disk doesn't
+# stall the event loop. At most [MAX_QUEUED_BATCHES] batches are queued for
+# it at once; past that, new records pile up in the next batch instead.
 @dataclass
 class Db:
     d: dict[User, MessageList]
+    # the directory holding the snapshot and log segments
     store_path: str
+    # only touched from the writer thread (once the event loop is running)
+    log: Any
+    window: float
+    max_batch: int
+    compact_bytes: int
+    seq: int
+    # the last record known to be on disk, and who to tell when that changes
+    durable_seq: int
+    on_durable: Optional[Callable[[], None]]
+    recent: collections.deque[dict[str, Any]]
+    # the segment new records go to, how much has been written to it, and how
+    # large the last snapshot was
+    segment: int
+    segment_size: int
+    snapshot_size: int
+    # records logged but not yet handed to the writer, and the future that
+    # resolves once they are durable
+    batch: list[bytes]
+    batch_done: Optional["asyncio.Future[None]"]
+    flush_timer: Optional[asyncio.TimerHandle]
+    # if set, the next job for the writer starts by writing this snapshot;
+    # see [commit]
+    snapshot: Optional[dict[str, Any]]
+    writer: concurrent.futures.ThreadPoolExecutor
+    queued: int
+    # resolves once everything handed to the writer so far is durable
+    last_queued: Optional["asyncio.Future[None]"]
 
-    def __init__(self, d, store_path):
+    def __init__(
+        self,
+        d,
+        store_path,
+        *,
+        seq=0,
+        recent=(),
+        window=config.DEFAULT_COMMIT_WINDOW,
+        max_batch=config.DEFAULT_COMMIT_BATCH,
+        compact_bytes=config.DEFAULT_COMPACT_BYTES,
+        replication_log=config.DEFAULT_REPLICATION_LOG,
+    ):
         self.d = wrap_message_lists(d)
         self.store_path = store_path
+        os.makedirs(self.store_path, exist_ok=True)
+        self.log = None
+        self.window = window
+        self.max_batch = max_batch
+        self.compact_bytes = compact_bytes
+        self.seq = seq
+        self.durable_seq = seq
+        self.on_durable = None
+        self.recent = collections.deque(recent, maxlen=replication_log)
+        # never reuse the number of a segment left over from a previous run
+        self.segment = max(Db.segments(self.store_path), default=0)
+        self.segment_size = 0
+        self.snapshot_size = 0
+        self.batch = []
+        self.batch_done = None
+        self.flush_timer = None
+        self.snapshot = None
+        # a single thread, so that jobs run in the order they're queued
+        self.writer = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="db-writer"
+        )
+        self.queued = 0
+        self.last_queued = None
+        # start from a snapshot of [d]
+        self.commit()
+
+    # Numbers of the log segments in [store_path], in order
+    @staticmethod
+    def segments(store_path: str) -> list[int]:
+        prefix, _ = SEGMENT_FORMAT.split("{")
+        try:
+            names = os.listdir(store_path)
+        except FileNotFoundError:
+            return []
+        return sorted(
+            int(name[len(prefix) :])
+            for name in names
+            if name.startswith(prefix) and name[len(prefix) :].isdigit()
+        )
+
+    # Read back the database stored in [store_path], along with the number of
+    # the last record, and the last [keep] records (to pass on to [Db])
+    @staticmethod
+    def replay(
+        store_path: str, keep: int = config.DEFAULT_REPLICATION_LOG
+    ) -> tuple[dict[User, list[Message]], int, list[dict[str, Any]]]:
+        d: dict[User, list[Message]] = {}
+        seq = 0
+        recent: collections.deque[dict[str, Any]] = collections.deque(maxlen=keep)
+        first_segment = 0
+
+        snapshot_path = os.path.join(store_path, SNAPSHOT_FILE)
+        try:
+            with open(snapshot_path, "rb") as f:
+                snapshot = serde.DEFAULT.loads(f.read())
+            seq = snapshot["seq"]
+            first_segment = snapshot["segment"]
+            for user, msgs in snapshot["db"].items():
+                d[user] = [message_of_jsonable(m) for m in msgs]
+        except FileNotFoundError:
+            pass
+
+        for segment in Db.segments(store_path):
+            # left behind by a crash before it could be deleted
+            if segment < first_segment:
+                continue
+            path = os.path.join(store_path, SEGMENT_FORMAT.format(segment))
+            with open(path, "rb") as f:
+                for line in f:
+                    try:
+                        record = serde.DEFAULT.loads(line)
+                    except serde.DecodeError:
+                        # the last record may have been cut short by a crash;
+                        # it was never acknowledged, so drop it
+                        break
+                    Db.apply(d, record)
+                    seq = record["seq"]
+                    recent.append(record)
+        return d, seq, list(recent)
+
+    # Read back a database stored in one of the [LEGACY_DB_FORMATS], or None
+    # if there is no such file
+    @staticmethod
+    def replay_legacy(path: str) -> Optional[dict[User, list[Message]]]:
+        d: dict[User, list[Message]] = {}
+        try:
+            with open(path, "rb") as f:
+                if path.endswith(".json"):
+                    for user, msgs in serde.DEFAULT.loads(f.read()).items():
+                        d[user] = [message_of_jsonable(m) for m in msgs]
+                    return d
+                for line in f:
+                    try:
+                        record = serde.DEFAULT.loads(line)
+                    except serde.DecodeError:
+                        # cut short by a crash, as in [replay]
+                        break
+                    Db.apply(d, record)
+        except FileNotFoundError:
+            return None
+        return d
+
+    @staticmethod
+    def apply(d: dict[User, list[Message]], record: dict[str, Any]) -> None:
+        op = record["op"]
+        if op == "append":
+            d[record["user"]].append(message_of_jsonable(record["msg"]))
+        elif op == "set":
+            d[record["user"]] = [message_of_jsonable(m) for m in record["msgs"]]
+        elif op == "del":
+            d.pop(record["user"], None)
+
+    # Apply [record], logged (and numbered) by the server upstream of us. It
+    # must be the one right after our last.
+    def apply_replicated(self, record: dict[str, Any]) -> None:
+        assert record["seq"] == self.seq + 1
+        op = record["op"]
+        user = record["user"]
+        if op == "append":
+            self.d[user].append(message_of_jsonable(record["msg"]))
+        elif op == "set":
+            self.d[user] = MessageList([message_of_jsonable(m) for m in record["msgs"]])
+        elif op == "del":
+            self.d.pop(user, None)
+        self.write(record)
+
+    # The records after number [seq], or None if we no longer have them all
+    def records_since(self, seq: int) -> Optional[list[dict[str, Any]]]:
+        if seq >= self.seq:
+            return []
+        if len(self.recent) == 0 or self.recent[0]["seq"] > seq + 1:
+            return None
+        start = seq + 1 - self.recent[0]["seq"]
+        return list(itertools.islice(self.recent, start, None))
 
     def __getitem__(self, item: User) -> MessageList:
         return self.d[item]
@@ -195,6 +483,7 @@ class Db:
     def fetch_pending_msgs(self, user: User):
         result = self.d[user]
         self.d[user] = MessageList([])
+        self.write({"op": "set", "user": user, "msgs": []})
 
         return MessageList(result) if isinstance(result, list) else result
 
@@ -206,7 +495,7 @@ class Db:
 
     def append_to(self, user, msg):
         self.d[user].append(msg)
-        self.commit()
+        self.write({"op": "append", "user": user, "msg": msg})
 
     def get(self, user: User) -> Optional[MessageList]:
         return self.d.get(user)
@@ -222,58 +511,371 @@ class Db:
             for k, v in self.d.items()
         }
 
-    def commit(self) -> None:
+    # Number [record], and add it to the current batch, starting one if need
+    # be
+    def write(self, record: dict[str, Any]) -> None:
+        self.seq += 1
+        record["seq"] = self.seq
+        self.recent.append(record)
+        data = serde.DEFAULT.dumps(record) + b"\n"
+        self.batch.append(data)
+        self.segment_size += len(data)
+        if self.segment_size >= max(self.compact_bytes, self.snapshot_size):
+            self.commit()
+        else:
+            self.schedule_flush()
+
+    def schedule_flush(self) -> None:
         try:
-            with open(self.store_path, "w") as f:
-                json.dump(self.to_jsonable_type(), f)
-                print("wrote file")
-        except IOError as e:
-            print("couldn't write file", e)
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # nothing to batch with (or wait on the batch) outside the loop
+            self.write_out(self.snapshot, b"".join(self.batch))
+            self.snapshot = None
+            self.batch.clear()
+            self.mark_durable(self.seq)
+            return
+        if self.batch_done is None:
+            self.batch_done = loop.create_future()
+        if len(self.batch) >= self.max_batch or self.snapshot is not None:
+            self.flush()
+        elif self.flush_timer is None:
+            self.flush_timer = loop.call_later(self.window, self.flush)
+
+    # Hand the current batch to the writer thread, unless its queue is full,
+    # in which case [on_written] will call us again once there's room
+    def flush(self) -> None:
+        if self.flush_timer is not None:
+            self.flush_timer.cancel()
+            self.flush_timer = None
+        if self.batch_done is None or self.queued >= MAX_QUEUED_BATCHES:
+            return
+
+        snapshot, self.snapshot = self.snapshot, None
+        data = b"".join(self.batch)
+        self.batch.clear()
+        done, self.batch_done = self.batch_done, None
+
+        loop = asyncio.get_running_loop()
+        written = loop.run_in_executor(self.writer, self.write_out, snapshot, data)
+        self.queued += 1
+        self.last_queued = done
+        # everything up to here is in this batch (or the snapshot)
+        seq = self.seq
+        written.add_done_callback(lambda f: self.on_written(f, done, seq))
+
+    def on_written(self, written: "asyncio.Future[None]", done, seq: int) -> None:
+        self.queued -= 1
+        error = written.exception()
+        if error is None:
+            self.mark_durable(seq)
+            done.set_result(None)
+        else:
+            print("couldn't write log", error)
             # in a real app, we'd log
-            pass
+            done.set_exception(StorageError(str(error)))
+            # nobody may be waiting on this batch
+            done.exception()
+        if self.batch_done is not None and self.flush_timer is None:
+            self.flush()
+
+    def mark_durable(self, seq: int) -> None:
+        self.durable_seq = seq
+        if self.on_durable is not None:
+            self.on_durable()
+
+    # (On the writer thread) Write [snapshot] if given, then append [data] to
+    # the current segment, and make sure it all reaches the disk
+    def write_out(self, snapshot: Optional[dict[str, Any]], data: bytes) -> None:
+        if snapshot is not None:
+            self.write_snapshot(snapshot)
+        if len(data) > 0:
+            self.log.write(data)
+            self.log.flush()
+            os.fsync(self.log.fileno())
+
+    # (On the writer thread) Switch to the segment [snapshot] starts, then put
+    # [snapshot] in place and delete the segments it covers. The snapshot is
+    # written to a temporary file and renamed over the old one only once
+    # complete, so a crash at any point leaves either the old snapshot and
+    # all segments since, or the new one.
+    def write_snapshot(self, snapshot: dict[str, Any]) -> None:
+        segment = snapshot["segment"]
+        if self.log is not None:
+            self.log.close()
+        self.log = open(
+            os.path.join(self.store_path, SEGMENT_FORMAT.format(segment)), "ab"
+        )
+
+        data = serde.DEFAULT.dumps(snapshot)
+        tmp_path = os.path.join(self.store_path, SNAPSHOT_FILE + ".tmp")
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, os.path.join(self.store_path, SNAPSHOT_FILE))
+        # make the rename itself durable before deleting anything
+        dir_fd = os.open(self.store_path, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+        self.snapshot_size = len(data)
+
+        for old in Db.segments(self.store_path):
+            if old < segment:
+                os.remove(os.path.join(self.store_path, SEGMENT_FORMAT.format(old)))
+
+    # Wait until every mutation made so far is on disk. Raises [StorageError]
+    # if writing it failed.
+    async def sync(self) -> None:
+        done = self.batch_done or self.last_queued
+        if done is not None:
+            # shielded, so that one waiter being cancelled doesn't cancel the
+            # batch for everyone else
+            await asyncio.shield(done)
+
+    # Wait for everything logged so far to reach the disk, then close the log
+    # and stop the writer thread. The [Db] can't be written to after this.
+    async def close(self) -> None:
+        try:
+            await self.sync()
+        finally:
+            self.writer.shutdown(wait=True)
+            if self.log is not None:
+                self.log.close()
+                self.log = None
+
+    # Replace the whole database with [d], as of record number [seq]
+    def reset(self, d, seq: int) -> None:
+        self.d = wrap_message_lists(d)
+        self.seq = seq
+        # these no longer lead up to [d]
+        self.recent.clear()
+        self.commit()
+
+    # Snapshot the current contents, and start a new log segment. Records
+    # not yet handed to the writer are covered by the snapshot, so they are
+    # dropped.
+    #
+    # The snapshot has to capture the contents as of [self.seq], so it is
+    # taken here, on the event loop, before anything else can change them.
+    # Only the message lists are copied, though (messages themselves are
+    # never changed once sent); turning the messages into JSON happens on
+    # the writer thread, in [write_snapshot].
+    def commit(self) -> None:
+        self.segment += 1
+        self.segment_size = 0
+        self.snapshot = {
+            "segment": self.segment,
+            "seq": self.seq,
+            "db": {user: list(msgs.data) for user, msgs in self.d.items()},
+        }
+        self.batch.clear()
+        self.schedule_flush()
 
     def __setitem__(self, k: User, v: MessageList):
         self.d[k] = v
-        self.commit()
+        # copied, as [recent] keeps the record around while [v] may change
+        self.write({"op": "set", "user": k, "msgs": list(v)})
 
     def __delitem__(self, user: User):
         del self.d[user]
-        self.commit()
+        self.write({"op": "del", "user": user})
 
 
+# Call [method] on [session] and return the result, raising the error it
+# responds with, if any
+async def call(session: jsonrpc.Session, method: str, *params: Any) -> Any:
+    resp = await session.request(method=method, params=list(params))
+    if resp.is_error:
+        error = resp.payload
+        raise jsonrpc.JsonRpcError(
+            code=error["code"], message=error["message"], data=error["data"]  # type: ignore
+        )
+    return resp.payload
+
+
+# A backup's end of the link to the server upstream of it. We indirect the
+# handlers through this object because they need the link itself, to pull
+# anything the backup is missing (see [State.catch_up]).
 class ReplicaSession:
+    upstream: jsonrpc.Session
     is_connected: bool
-    update_db_handler: Callable[[Db, Optional[float]], Awaitable[Ok]]
+    accept_handler: Callable[[jsonrpc.Session, int], Awaitable[ReplicaPosition]]
+    replicate_handler: Callable[[jsonrpc.Session, list[dict[str, Any]], int], Ok]
 
-    def __init__(self, update_db_handler):
+    def __init__(self, upstream, accept_handler, replicate_handler):
+        self.upstream = upstream
         self.is_connected = False
-        self.update_db_handler = update_db_handler
+        self.accept_handler = accept_handler
+        self.replicate_handler = replicate_handler
 
-    async def accept(self, db: Db, mtime: Optional[float]) -> Ok:
+    async def accept(self, seq: int) -> ReplicaPosition:
         print("accepted connection from upstream")
         self.is_connected = True
-        return await self.update_db_handler(db, mtime)
+        return await self.accept_handler(self.upstream, seq)
+
+    def replicate(self, records: list[dict[str, Any]], head: int) -> Ok:
+        return self.replicate_handler(self.upstream, records, head)
+
+
+# What a server serves to a peer catching up from it (see [State.catch_up]).
+# A snapshot is taken when its first chunk is asked for, and kept until the
+# last one has been sent, so that the chunks agree with each other even as
+# the database keeps changing.
+class ReplicaSource:
+    db: Db
+    chunk_size: int
+    snapshot: Optional[tuple[int, list[tuple[User, Any]]]]
+    # Called on every fetch, as a sign of life from the peer
+    on_fetch: Optional[Callable[[], None]]
+
+    def __init__(self, db: Db, chunk_size: int, on_fetch=None):
+        self.db = db
+        self.chunk_size = chunk_size
+        self.snapshot = None
+        self.on_fetch = on_fetch
+
+    def fetch_records(self, since: int) -> RecordList:
+        if self.on_fetch is not None:
+            self.on_fetch()
+        return RecordList(self.db.records_since(since))
+
+    def fetch_snapshot(self, offset: int) -> SnapshotChunk:
+        if self.on_fetch is not None:
+            self.on_fetch()
+        if offset == 0 or self.snapshot is None:
+            self.snapshot = (self.db.seq, list(self.db.to_jsonable_type().items()))
+        seq, users = self.snapshot
+        end = offset + self.chunk_size
+        if end >= len(users):
+            self.snapshot = None
+        return SnapshotChunk(seq, users[offset:end], end >= len(users))
 
 
 @dataclass
 class ReplicaInfo:
     next: Optional[jsonrpc.Session]
     tail: list[Address]
-
-    async def forward(self, method: str, *args):
-        if self.next is None:
-            return
-        if not self.next.is_running:
+    # Called with each backup we connect to, before anything is sent to it;
+    # see [State.connect_downstream]
+    on_connect: Optional[Callable[[jsonrpc.Session], Awaitable[None]]] = None
+
+    # The link to the backup after us, or if it's been lost (or not yet
+    # opened), to the next one after that which we can reach. None once there
+    # are none left.
+    async def link(self) -> Optional[jsonrpc.Session]:
+        while self.next is None or not self.next.is_running:
             if len(self.tail) == 0:
-                return
+                self.next = None
+                break
             next_addr, *self.tail = self.tail
-            next_conn = await asyncio.open_connection(*next_addr)
-            self.next = jsonrpc.spawn_session(*next_conn)
+            try:
+                next_conn = await asyncio.wait_for(
+                    asyncio.open_connection(*next_addr), REPLICA_TIMEOUT
+                )
+            except (OSError, asyncio.TimeoutError):
+                continue
+            self.next = jsonrpc.spawn_session(
+                *next_conn,
+                timeout=REPLICA_TIMEOUT,
+                cork=True,
+                compression=COMPRESSION,
+            )
             self.next.run_in_background(self.next.run_event_loop())
-            await self.next.request(method="register_replica_source", params=[{}, -1])
-            return await self.forward(method, *args)
-        assert self.next is not None
-        await self.next.request(method=method, params=args)
+            try:
+                await asyncio.wait_for(self.next.session.negotiate(), REPLICA_TIMEOUT)
+                await self.next.negotiate_encoding(*BINARY_ENCODINGS)
+                if self.on_connect is not None:
+                    await self.on_connect(self.next)
+            except Exception as e:
+                # Whatever went wrong (a timeout, a reset connection, a
+                # failure while catching up from it...), a backup we couldn't
+                # introduce ourselves to is no use to us. Moving on to the
+                # next one is what lets [State.relink] finish, and the writes
+                # waiting on the chain carry on.
+                print("backup unresponsive, skipping it", e)
+                self.next.close()
+        return self.next
+
+
+# A primary's end of a link from the primary of another shard. [deliver] is
+# only served once the peer has said which server it is, and proven that it
+# is one of ours with the shard secret (see [State.accept_shard_peer]), so
+# that clients can't hand us messages in anyone's name.
+class ShardPeerSession:
+    peer: jsonrpc.Session
+    accept_handler: Callable[[jsonrpc.Session, Address, str], Ok]
+
+    def __init__(self, peer, accept_handler):
+        self.peer = peer
+        self.accept_handler = accept_handler
+
+    def register(self, host: str, port: int, secret: str) -> Ok:
+        return self.accept_handler(self.peer, (Host(host), Port(port)), secret)
+
+
+# Connections to the primaries of the other shards, over which we pass on
+# messages sent to their users. Each is opened on first use, and reopened once
+# lost, trying the servers of the shard's chain in order.
+class ShardLinks:
+    cfg: config.Config
+    # our own address, to introduce ourselves with
+    addr: Address
+    links: dict[int, "asyncio.Future[jsonrpc.Session]"]
+
+    def __init__(self, cfg: config.Config, addr: Address):
+        self.cfg = cfg
+        self.addr = addr
+        self.links = dict()
+
+    async def connect(self, shard: int) -> jsonrpc.Session:
+        for addr in self.cfg.shards[shard].servers:
+            try:
+                conn = await asyncio.wait_for(
+                    asyncio.open_connection(*addr), REPLICA_TIMEOUT
+                )
+            except (OSError, asyncio.TimeoutError):
+                continue
+            sess = jsonrpc.spawn_session(
+                *conn, timeout=REPLICA_TIMEOUT, cork=True, compression=COMPRESSION
+            )
+            sess.run_in_background(sess.run_event_loop())
+            # only the primary accepts shard peers
+            try:
+                resp = await sess.request(
+                    method="register_shard_peer",
+                    params=[*self.addr, self.cfg.shard_secret],
+                )
+            except (asyncio.TimeoutError, Disconnected):
+                sess.close()
+                continue
+            if not resp.is_error:
+                return sess
+            sess.close()
+        raise ShardUnavailable(shard)
+
+    async def link(self, shard: int) -> jsonrpc.Session:
+        fut = self.links.get(shard)
+        if fut is not None and fut.done():
+            if fut.cancelled() or fut.exception() is not None:
+                fut = None
+            elif not fut.result().is_running:
+                fut = None
+        if fut is None:
+            # concurrent senders share a single connection attempt
+            fut = self.links[shard] = asyncio.ensure_future(self.connect(shard))
+        return await fut
+
+    # Hand [msg] to the primary of [shard], which its recipient lives on
+    async def deliver(self, shard: int, msg: Message) -> Ok:
+        sess = await self.link(shard)
+        try:
+            await call(sess, "deliver", msg.to_jsonable_type())
+        except (asyncio.TimeoutError, Disconnected):
+            raise ShardUnavailable(shard)
+        return Ok()
 
 
 # XXX: This is copy-pasted from [jsonrpc.py].
@@ -296,7 +898,30 @@ class State:
     replica_info: ReplicaInfo
     cfg: config.Config
     addr: Address
-    mtime: Optional[float]
+    # How far down the log we've sent to the backup after us, and how far it
+    # has acknowledged (None while we're still connecting to it); see [push]
+    forwarded_seq: int
+    downstream_seq: Optional[int]
+    # The last record durable here and on every backup after us, and the
+    # callers waiting on it (in order of their records); see [update_acked]
+    acked_seq: int
+    ack_waiters: collections.deque[tuple[int, "asyncio.Future[None]"]]
+    # The server before us in the chain, if any, and the latest record it has
+    # told us about
+    upstream: Optional[jsonrpc.Session]
+    upstream_seq: int
+    # Records from upstream that we can't apply yet, by sequence number; see
+    # [drain_held]
+    held: dict[int, dict[str, Any]]
+    # Held while pulling records from another server; see [catch_up]
+    catching_up: asyncio.Lock
+    reconnecting: Optional[asyncio.Task]
+    # Fires if the backup after us goes quiet; see [on_stalled]
+    stall_timer: Optional[asyncio.TimerHandle]
+    # Which shard we serve; users of other shards are reached via
+    # [shard_links]
+    shard: int
+    shard_links: ShardLinks
 
     def __init__(
         self,
@@ -305,22 +930,185 @@ class State:
         db: Db,
         is_primary: bool,
         replica_info: ReplicaInfo,
-        mtime: Optional[float],
     ):
         self.db = db
         self.logins = dict()
         self.is_primary = is_primary
         self.replica_info = replica_info
+        self.replica_info.on_connect = self.connect_downstream
         self.cfg = cfg
         self.addr = addr
-        self.mtime = mtime
+        self.forwarded_seq = db.seq
+        self.downstream_seq = None
+        self.acked_seq = db.seq
+        self.ack_waiters = collections.deque()
+        self.db.on_durable = self.update_acked
+        self.upstream = None
+        self.upstream_seq = db.seq
+        self.held = dict()
+        self.catching_up = asyncio.Lock()
+        self.reconnecting = None
+        self.stall_timer = None
+        self.shard = cfg.shard_index(addr)
+        self.shard_links = ShardLinks(cfg, addr)
+
+    # Every mutation is followed by a call to this, which sends it down the
+    # chain and waits until it's durable here and on every backup after us.
+    # Mutations don't wait on each other: many can be on their way down the
+    # chain at once.
+    async def replicate(self) -> None:
+        acked = self.wait_acked(self.db.seq)
+        self.push()
+        # raises if writing it out here failed
+        await self.db.sync()
+        await acked
+
+    def wait_acked(self, seq: int) -> "asyncio.Future[None]":
+        result = asyncio.get_running_loop().create_future()
+        if seq <= self.acked_seq:
+            result.set_result(None)
+        else:
+            self.ack_waiters.append((seq, result))
+        return result
+
+    # Send the records the backup after us doesn't have yet, up to
+    # [replication_window] past what it has acknowledged. They go as a single
+    # notification, without waiting on anything: the backup applies them,
+    # passes them on in turn, and acknowledges them (see [on_ack]) once
+    # they're durable all the way down the chain.
+    def push(self) -> None:
+        next = self.replica_info.next
+        if next is None:
+            return
+        if not next.is_running:
+            self.reconnect()
+            return
+        if self.downstream_seq is None:
+            # still introducing ourselves; see [connect_downstream]
+            return
+        head = min(self.db.seq, self.downstream_seq + self.cfg.replication_window)
+        if head <= self.forwarded_seq:
+            return
+        records = self.db.records_since(self.forwarded_seq)
+        if records is not None:
+            records = records[: head - self.forwarded_seq]
+        self.forwarded_seq = head
+        # If we no longer have them all, the backup will notice the gap, and
+        # catch up from us instead
+        next.notify_nowait(method="replicate", params=[records or [], head])
+        self.arm_stall_timer()
+
+    def reconnect(self) -> None:
+        if self.reconnecting is None or self.reconnecting.done():
+            self.reconnecting = asyncio.create_task(self.relink())
+
+    async def relink(self) -> None:
+        self.downstream_seq = None
+        if self.stall_timer is not None:
+            self.stall_timer.cancel()
+            self.stall_timer = None
+        # (this introduces us to the new backup, if any)
+        await self.replica_info.link()
+        # with no backups left, we only have ourselves to wait on
+        self.update_acked()
+        self.push()
+
+    def arm_stall_timer(self) -> None:
+        if self.stall_timer is None:
+            loop = asyncio.get_running_loop()
+            self.stall_timer = loop.call_later(REPLICA_TIMEOUT, self.on_stalled)
+
+    # The backup after us is fetching from us to catch up, which can take a
+    # while before it acknowledges anything; it isn't stalled as long as it
+    # keeps at it
+    def on_downstream_fetch(self) -> None:
+        if self.stall_timer is not None:
+            self.stall_timer.cancel()
+            self.stall_timer = None
+            self.arm_stall_timer()
+
+    # The backup after us hasn't acknowledged anything for [REPLICA_TIMEOUT]
+    # seconds. A stalled backup is as good as a dead one: drop it, and move on
+    # to the next server in the chain.
+    def on_stalled(self) -> None:
+        self.stall_timer = None
+        print("backup unresponsive, skipping it")
+        if self.replica_info.next is not None:
+            self.replica_info.next.close()
+        self.push()
+
+    # Handler for acknowledgements from the backup after us: everything up to
+    # [seq] is durable there and beyond
+    def on_ack(self, seq: int) -> Ok:
+        if self.downstream_seq is None or seq <= self.downstream_seq:
+            return Ok()
+        self.downstream_seq = seq
+        if self.stall_timer is not None:
+            self.stall_timer.cancel()
+            self.stall_timer = None
+        if self.forwarded_seq > seq:
+            self.arm_stall_timer()
+        self.update_acked()
+        # there's room in the window again
+        self.push()
+        return Ok()
 
-    async def forward(self, method: str, *args):
-        await self.replica_info.forward(method, *args)
+    # Recompute [acked_seq] (called whenever what it's made of changes), and
+    # pass on any progress: to callers waiting on it, and upstream
+    def update_acked(self) -> None:
+        acked = self.db.durable_seq
+        if self.replica_info.next is not None:
+            if self.downstream_seq is None:
+                return
+            acked = min(acked, self.downstream_seq)
+        if acked <= self.acked_seq:
+            return
+        self.acked_seq = acked
+        while len(self.ack_waiters) > 0 and self.ack_waiters[0][0] <= acked:
+            _, result = self.ack_waiters.popleft()
+            if not result.done():
+                result.set_result(None)
+        if self.upstream is not None and self.upstream.is_running:
+            self.upstream.notify_nowait(method="ack", params=[acked])
+
+    # Pull whatever we're missing from [peer]: the records after our last
+    # one, or if it no longer has them all, a snapshot (in chunks, so that no
+    # single message holds the whole database) and then the records after
+    # that. Call with [catching_up] held.
+    async def catch_up(self, peer: jsonrpc.Session) -> None:
+        while True:
+            records = await call(peer, "fetch_records", self.db.seq)
+            if records is not None:
+                break
+            await self.load_snapshot(peer)
+        for record in records:
+            if record["seq"] == self.db.seq + 1:
+                self.db.apply_replicated(record)
+        await self.db.sync()
+
+    async def load_snapshot(self, peer: jsonrpc.Session) -> None:
+        print("too far behind, fetching a snapshot")
+        d: dict[User, list[Message]] = {}
+        seq = None
+        done = False
+        while not done:
+            chunk = await call(peer, "fetch_snapshot", len(d))
+            if seq is not None and chunk["seq"] != seq:
+                # the snapshot was retaken part way through; start over
+                d.clear()
+                seq = None
+                continue
+            seq = chunk["seq"]
+            for user, msgs in chunk["users"]:
+                d[user] = [message_of_jsonable(m) for m in msgs]
+            done = chunk["done"]
+        assert seq is not None
+        self.db.reset(d, seq)
 
     async def retrieve_pending(self, user: User) -> MessageList:
-        await self.forward("retrieve_pending", user)
-        return self.db.fetch_pending_msgs(user)
+        pending = self.db.fetch_pending_msgs(user)
+        await self.replicate()
+        return pending
 
     async def handle_login(self, session: UserSession, user: User) -> MessageList:
         if user not in self.db:
@@ -340,11 +1128,15 @@ class State:
         if not isinstance(msg, Message):
             msg = Message(msg["sender"], msg["recipient"], msg["content"])
         self.db.append_to(msg.recipient, msg)
-        await self.forward("store_msg", msg.to_jsonable_type())
+        await self.replicate()
 
         return Ok()
 
     async def handle_send_message(self, msg: Message) -> Ok:
+        shard = self.cfg.shard_of(msg.recipient)
+        if shard != self.shard:
+            return await self.shard_links.deliver(shard, msg)
+
         # Send the message to user
         if msg.recipient not in self.db:
             raise NoSuchUser(msg.recipient)
@@ -358,48 +1150,145 @@ class State:
 
         return Ok()
 
+    # Handler for messages to our users, passed on by another shard's primary
+    async def deliver(self, msg) -> Ok:
+        return await self.handle_send_message(
+            Message(msg["sender"], msg["recipient"], msg["content"])
+        )
+
     async def create_user(self, name: User) -> Ok:
+        shard = self.cfg.shard_of(name)
+        if shard != self.shard:
+            raise WrongShard(name, shard)
         if name in self.db:
             raise UserAlreadyExists(name)
 
         self.db[name] = MessageList([])
-        await self.forward("create_user", name)
+        await self.replicate()
 
         return Ok()
 
-    async def list_users(self, *args) -> UserList:
+    def list_users(self, *args) -> UserList:
         return UserList(list(self.db.keys()))
 
     async def delete_user(self, user: User) -> Ok:
         if user in self.db:
             del self.db[user]
-        await self.forward("delete_user", user)
+        await self.replicate()
 
         # If it's not there, oh well. The point of [delete_user] is to produce
         # a server state in which the desired user no longer exists, so if that
         # user didn't exist in the first place, cool.
         return Ok()
 
-    async def accept_client(self) -> Ok:
+    # These handlers (and [list_users]) are cheap and never wait on anything,
+    # so we register them as inline handlers.
+    def accept_client(self) -> Ok:
         return Ok()
 
-    async def reject_client(self) -> NoReturn:
+    def reject_client(self, *args) -> NoReturn:
         raise ImABackup()
 
-    async def reject_replica_source(self, *args, **kwargs) -> NoReturn:
+    # Let [peer], which claims to be the server at [addr], [deliver] messages
+    # to us. [addr] has to be a server of another shard, and [secret] has to be
+    # the config's [shard_secret]; no address alone proves who a peer is.
+    def accept_shard_peer(
+        self, peer: jsonrpc.Session, addr: Address, secret: str
+    ) -> Ok:
+        host, port = addr
+        expected = self.cfg.shard_secret
+        # (compared in constant time, so that it can't be guessed bit by bit)
+        if expected is None or not hmac.compare_digest(
+            secret.encode(transport.STRING_ENCODING),
+            expected.encode(transport.STRING_ENCODING),
+        ):
+            raise UnknownPeer(host, port)
+        if addr not in self.cfg or self.cfg.shard_index(addr) == self.shard:
+            raise UnknownPeer(host, port)
+        peer.register_handler("deliver", self.deliver)
+        return Ok()
+
+    def reject_replica_source(self, *args, **kwargs) -> NoReturn:
         raise ImPrimary()
 
-    async def update_db(self, db, mtime: Optional[float]) -> Union[Ok, DbUpdate]:
-        if (self.mtime or -1) < (mtime or -1):
+    # Introduce ourselves to a backup we've just connected to. It pulls
+    # whatever it's missing from us; should it be ahead of us instead (say, we
+    # were restarted with an old log), we pull from it.
+    async def connect_downstream(self, next: jsonrpc.Session) -> None:
+        source = ReplicaSource(
+            self.db, self.cfg.snapshot_chunk, self.on_downstream_fetch
+        )
+        next.register_handler("fetch_records", source.fetch_records, inline=True)
+        next.register_handler("fetch_snapshot", source.fetch_snapshot, inline=True)
+        next.register_handler("ack", self.on_ack, inline=True)
+        their_seq = await call(next, "register_replica_source", self.db.seq)
+        if their_seq > self.db.seq:
+            print("backup reported newer db, updating")
+            async with self.catching_up:
+                await self.catch_up(next)
+        self.forwarded_seq = self.downstream_seq = their_seq
+        self.update_acked()
+        self.push()
+
+    # Handlers for the server upstream of us, [upstream]
+
+    # We answer right away, and catch up in the background: that can take
+    # longer than upstream is willing to wait for an answer. Upstream starts
+    # sending records from where we are now in the meantime.
+    async def accept_upstream(
+        self, upstream: jsonrpc.Session, seq: int
+    ) -> ReplicaPosition:
+        self.upstream = upstream
+        self.upstream_seq = max(self.upstream_seq, seq)
+        # whatever the old upstream sent is resent from our position
+        self.held.clear()
+        if seq > self.db.seq:
             print("upstream reported newer db, updating")
-            self.mtime = mtime
-            self.db.d = db
-            self.db.commit()
-            await self.forward("update_db", self.db.d, self.mtime)
-            return Ok()
-        else:
-            print("current db is newer than upstram")
-            return DbUpdate(self.db.d, self.mtime)
+            run_in_background(pending_jobs, self.catch_up_with(upstream))
+        return ReplicaPosition(self.db.seq)
+
+    # (Inline, so that records are applied in the order they arrive)
+    def apply_replicated(
+        self, upstream: jsonrpc.Session, records: list[dict[str, Any]], head: int
+    ) -> Ok:
+        self.upstream = upstream
+        self.upstream_seq = max(self.upstream_seq, head)
+        catching_up = self.catching_up.locked()
+        for record in records:
+            seq = record["seq"]
+            if seq == self.db.seq + 1 and not catching_up:
+                self.db.apply_replicated(record)
+            elif seq > self.db.seq:
+                # (we skip any we already have)
+                self.held[seq] = record
+        # while catching up, [catch_up_with] applies these once it's done
+        if not catching_up:
+            self.drain_held()
+            if self.db.seq < self.upstream_seq:
+                # we missed some (e.g. while upstream was failing over)
+                run_in_background(pending_jobs, self.catch_up_with(upstream))
+        self.push()
+        return Ok()
+
+    # Apply the held records that follow on from our last one, and drop those
+    # we have since got some other way
+    def drain_held(self) -> None:
+        for seq in [seq for seq in self.held if seq <= self.db.seq]:
+            del self.held[seq]
+        while self.db.seq + 1 in self.held:
+            self.db.apply_replicated(self.held.pop(self.db.seq + 1))
+
+    async def catch_up_with(self, upstream: jsonrpc.Session) -> None:
+        try:
+            async with self.catching_up:
+                while self.db.seq < self.upstream_seq:
+                    await self.catch_up(upstream)
+                    self.drain_held()
+        except (OSError, asyncio.TimeoutError, Disconnected, jsonrpc.JsonRpcError) as e:
+            # in a real app, we'd log; we'll try again on the next records
+            print("couldn't catch up with upstream", e)
+            return
+        self.push()
 
     async def elect_leader(self) -> None:
         # Ping every server in the up-line. If any responds, that server is the
@@ -423,18 +1312,23 @@ class State:
         self.is_primary = True
 
     async def handle_as_backup(self, session: jsonrpc.Session) -> None:
-        replica_session = ReplicaSession(self.update_db)
+        replica_session = ReplicaSession(
+            session, self.accept_upstream, self.apply_replicated
+        )
+        # upstream may need to catch up from us in turn
+        source = ReplicaSource(self.db, self.cfg.snapshot_chunk)
 
         session.register_handler("register_replica_source", replica_session.accept)
-        session.register_handler("update_db", self.update_db)
-        session.register_handler("register_client", self.reject_client)
-        session.register_handler("retrieve_pending", self.retrieve_pending)
-        session.register_handler("create_user", self.create_user)
-        session.register_handler("delete_user", self.delete_user)
-        session.register_handler("store_msg", self.store_msg)
+        session.register_handler("replicate", replica_session.replicate, inline=True)
+        session.register_handler("fetch_records", source.fetch_records, inline=True)
+        session.register_handler("fetch_snapshot", source.fetch_snapshot, inline=True)
+        session.register_handler("register_client", self.reject_client, inline=True)
+        session.register_handler("register_shard_peer", self.reject_client, inline=True)
 
         await session.run_event_loop()
 
+        if self.upstream is session:
+            self.upstream = None
         if replica_session.is_connected:
             print("upstream connection lost, checking precedents")
             await self.elect_leader()
@@ -445,12 +1339,18 @@ class State:
         user_session = UserSession(
             session, self.handle_login, self.handle_logout, self.handle_send_message
         )
+        shard_peer = ShardPeerSession(session, self.accept_shard_peer)
 
-        session.register_handler("register_replica_source", self.reject_replica_source)
-        session.register_handler("register_client", self.accept_client)
+        session.register_handler(
+            "register_replica_source", self.reject_replica_source, inline=True
+        )
+        session.register_handler("register_client", self.accept_client, inline=True)
+        session.register_handler(
+            "register_shard_peer", shard_peer.register, inline=True
+        )
         session.register_handler("login", user_session.login)
         session.register_handler("create_user", self.create_user)
-        session.register_handler("list_users", self.list_users)
+        session.register_handler("list_users", self.list_users, inline=True)
         session.register_handler("delete_user", self.delete_user)
         session.register_handler("send", user_session.send_message)
 
@@ -458,8 +1358,21 @@ class State:
         user_session.cleanup()
 
     async def handle_incoming(self, reader, writer) -> None:
-        session = jsonrpc.spawn_session(reader, writer)
-        session.register_handler("ping", ping)
+        # Corking lets fan-out of many small notifications/forwards share a
+        # single socket write.
+        session = jsonrpc.spawn_session(
+            reader,
+            writer,
+            max_jobs=self.cfg.max_jobs_per_session,
+            max_message_size=self.cfg.max_message_size,
+            max_pending_bytes=self.cfg.max_pending_bytes,
+            cork=True,
+            compression=COMPRESSION,
+            # old clients don't know about hellos, so only answer theirs
+            accepting=True,
+        )
+        session.register_handler("ping", ping, inline=True)
+        session.register_handler("stats", stats, inline=True)
 
         if self.is_primary:
             await self.handle_as_primary(session)
@@ -477,49 +1390,57 @@ async def main(host: str, port: int):
             f"refusing to bind to address {host}:{port} not listed in config.json"
         )
 
-    try:
-        db_path = SERVER_DB_FORMAT.format(host=host, port=port)
-        with open(db_path, "r") as f:
-            db, mtime = json.load(f), os.path.getmtime(db_path)
-    except FileNotFoundError:
-        db, mtime = {}, None
+    db_path = SERVER_DB_FORMAT.format(host=host, port=port)
+    db, seq, recent = Db.replay(db_path, cfg.replication_log)
+    if not os.path.isdir(db_path):
+        for legacy_format in LEGACY_DB_FORMATS:
+            legacy_path = legacy_format.format(host=host, port=port)
+            legacy = Db.replay_legacy(legacy_path)
+            if legacy is not None:
+                print(f"importing {legacy_path} into {db_path}")
+                # Counted as a single record, so that a backup starting out
+                # empty (at 0) is sent all of it. The old file is left alone.
+                db, seq, recent = legacy, 1, []
+                break
+
+    jsonrpc.GLOBAL_JOBS.limit = cfg.max_jobs
+    transport.GLOBAL_REASSEMBLY.limit = cfg.max_reassembly_bytes
+    if cfg.stats_interval is not None:
+        run_in_background(pending_jobs, metrics.dump_periodically(cfg.stats_interval))
 
     is_primary = cfg.am_i_primary(addr)
     backups = cfg.following(addr)
 
-    if len(backups) == 0:
-        next = None
-        tail = []
-    else:
-        first_backup_addr, *tail = backups
-        backup_host, backup_port = first_backup_addr
-        next_conn = await asyncio.open_connection(*first_backup_addr)
-        next = jsonrpc.spawn_session(*next_conn)
-        run_in_background(pending_jobs, next.run_event_loop())
-        resp = await next.request(method="register_replica_source", params=[db, mtime])
-        if resp.payload != "ok":
-            db = resp.payload["db"]  # type: ignore
-            mtime = resp.payload["mtime"]  # type: ignore
-
     db_ = Db(
         db,
-        SERVER_DB_FORMAT.format(host=host, port=port),
+        db_path,
+        seq=seq,
+        recent=recent,
+        window=cfg.commit_window,
+        max_batch=cfg.commit_batch,
+        compact_bytes=cfg.compact_bytes,
+        replication_log=cfg.replication_log,
     )
 
-    db_.commit()
+    await db_.sync()
 
     state = State(
         cfg,
         addr,
         db_,
         is_primary,
-        ReplicaInfo(next=next, tail=tail),
-        mtime,
+        ReplicaInfo(next=None, tail=backups),
     )
+    # Connect to the first backup we can reach, skipping any that are down or
+    # don't answer, just like when one is lost later on
+    await state.replica_info.link()
 
     server = await asyncio.start_server(state.handle_incoming, host, port)
-    async with server:
-        await server.serve_forever()
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        await db_.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,45 @@
+# Placement of users on shards (independent replica chains; see
+# [config.Shard]) by consistent hashing.
+#
+# Each shard is hashed onto a ring at [VNODES] points, and a user belongs to
+# the shard owning the first point at or after the user's own hash. Adding a
+# shard therefore only moves the users that land on its points, rather than
+# reshuffling almost everyone as [hash(user) % len(shards)] would. Shards are
+# identified on the ring by name, not position, so reordering the config
+# doesn't move anyone either.
+
+import bisect
+import hashlib
+
+from common import User
+
+# Points per shard; more points even out the share of users each shard gets
+VNODES = 64
+
+
+# A stable 64-bit hash (unlike [hash], which is salted per process, and would
+# have servers and clients disagree)
+def ring_hash(key: str) -> int:
+    digest = hashlib.blake2b(key.encode("utf8"), digest_size=8).digest()
+    return int.from_bytes(digest, "big")
+
+
+class HashRing:
+    # sorted positions of all points, and the index of the shard owning each
+    points: list[int]
+    owners: list[int]
+
+    def __init__(self, names: list[str]):
+        ring = sorted(
+            (ring_hash(f"{name}#{i}"), idx)
+            for idx, name in enumerate(names)
+            for i in range(VNODES)
+        )
+        self.points = [point for point, _ in ring]
+        self.owners = [idx for _, idx in ring]
+
+    # Index of the shard that [user] lives on
+    def shard_of(self, user: User) -> int:
+        i = bisect.bisect_left(self.points, ring_hash(user))
+        # wrap around past the last point
+        return self.owners[i % len(self.points)]
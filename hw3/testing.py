@@ -211,7 +211,7 @@ class TestChat(unittest.IsolatedAsyncioTestCase):
         ok = await state.create_user("cat")
         self.assertEqual(ok.to_jsonable_type(), "ok")
 
-        lst = await state.list_users()
+        lst = state.list_users()
         self.assertEqual(lst, UserList(data=["ana", "cam", "cat"]))
 
         serv.close()
@@ -220,7 +220,7 @@ class TestChat(unittest.IsolatedAsyncioTestCase):
     async def test_list_users_empty(self):
         state, serv = await self.setup()
 
-        lst = await state.list_users()
+        lst = state.list_users()
         self.assertEqual(lst, UserList(data=[]))
 
         serv.close()
@@ -237,7 +237,7 @@ class TestChat(unittest.IsolatedAsyncioTestCase):
         self.assertEqual(okdel.to_jsonable_type(), "ok")
         self.assertTrue("ana" not in state.known_users)
 
-        lst = await state.list_users()
+        lst = state.list_users()
         self.assertEqual(lst, UserList(data=[]))
 
         serv.close()
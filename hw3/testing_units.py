@@ -0,0 +1,968 @@
+import unittest
+import asyncio
+import json
+import os
+import socket
+import tempfile
+from typing import Optional
+import zlib
+from common import Disconnected, Host, Ok, Port, User
+from server import Db, Message, MessageList, ReplicaInfo, State
+import config
+import jsonrpc
+import serde
+import sharding
+import transport
+
+# Tests for the layers under the chat server, which (unlike [testing.py]) need
+# neither a client nor a running server.
+#
+# python3 -m unittest testing_units.py
+
+
+################ TESTING THE LOG ################
+
+
+class TestDb(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        # (registered first, so that it runs after every [Db] is closed)
+        self.addCleanup(self.tmp.cleanup)
+        self.path = os.path.join(self.tmp.name, "db")
+
+    # A [Db] at [self.path], closed once the test is over
+    def db(self, d=None, **kwargs):
+        db = Db(d or {}, self.path, **kwargs)
+        self.addAsyncCleanup(db.close)
+        return db
+
+    # Replay [self.path], as a server would on startup, in the same shape as
+    # [Db.to_jsonable_type]
+    def replay(self):
+        d, seq, recent = Db.replay(self.path)
+        return {u: [m.to_jsonable_type() for m in msgs] for u, msgs in d.items()}, seq
+
+    # Log [n] + 3 records: two users are created, [n] messages sent, and one
+    # user deleted
+    async def fill(self, db, n):
+        db["ana"] = MessageList([])
+        db["cam"] = MessageList([])
+        for i in range(n):
+            db.append_to("cam", Message(User("ana"), User("cam"), f"msg {i}"))
+        del db["ana"]
+        await db.sync()
+
+    async def test_replay_log(self):
+        db = self.db()
+        await self.fill(db, 10)
+
+        d, seq = self.replay()
+        self.assertEqual(seq, db.seq)
+        self.assertEqual(seq, 13)
+        self.assertEqual(d, db.to_jsonable_type())
+
+        _, _, recent = Db.replay(self.path, 4)
+        self.assertEqual([record["seq"] for record in recent], [10, 11, 12, 13])
+
+    async def test_replay_torn_record(self):
+        db = self.db()
+        await self.fill(db, 3)
+        expected = db.to_jsonable_type()
+
+        # a crash part way through writing the last record
+        segment = max(Db.segments(self.path))
+        with open(os.path.join(self.path, f"log.{segment:08d}"), "ab") as f:
+            f.write(b'{"op": "append", "user": "cam", "ms')
+
+        d, seq = self.replay()
+        self.assertEqual(seq, 6)
+        self.assertEqual(d, expected)
+
+    async def test_snapshot_is_a_copy(self):
+        db = self.db()
+        await self.fill(db, 2)
+        db.commit()
+        # made before the writer gets to the snapshot, but after it was taken
+        db.append_to("cam", Message(User("ana"), User("cam"), "late"))
+        await db.sync()
+
+        d, seq = self.replay()
+        self.assertEqual(seq, 6)
+        self.assertEqual([m["content"] for m in d["cam"]], ["msg 0", "msg 1", "late"])
+
+    async def test_close(self):
+        db = self.db()
+        await self.fill(db, 1)
+        db.append_to("cam", Message(User("ana"), User("cam"), "unsynced"))
+        await db.close()
+
+        self.assertIsNone(db.log)
+        with self.assertRaises(RuntimeError):
+            db.writer.submit(print)
+        d, seq = self.replay()
+        self.assertEqual(seq, 5)
+        self.assertEqual(d, db.to_jsonable_type())
+
+    async def test_compaction(self):
+        db = self.db(compact_bytes=500)
+        await self.fill(db, 50)
+        first = db.segment
+
+        # each compaction starts a segment and deletes those before it
+        self.assertGreater(first, 2)
+        self.assertEqual(Db.segments(self.path), [first])
+        d, seq = self.replay()
+        self.assertEqual(seq, 53)
+        self.assertEqual(d, db.to_jsonable_type())
+
+        # a restart picks up where we left off, in a new segment
+        await db.close()
+        d, seq, recent = Db.replay(self.path)
+        db = self.db(d, seq=seq, recent=recent)
+        db.append_to("cam", Message(User("cam"), User("cam"), "again"))
+        await db.sync()
+        self.assertGreater(db.segment, first)
+        d, seq = self.replay()
+        self.assertEqual(seq, 54)
+        self.assertEqual(d["cam"][-1]["content"], "again")
+
+    def test_replay_legacy(self):
+        msg = {"sender": "ana", "recipient": "cam", "content": "hi"}
+        json_path = os.path.join(self.tmp.name, "db.json")
+        with open(json_path, "w") as f:
+            json.dump({"ana": [], "cam": [msg]}, f)
+        log_path = os.path.join(self.tmp.name, "db.log")
+        with open(log_path, "w") as f:
+            f.write(json.dumps({"op": "set", "user": "cam", "msgs": []}) + "\n")
+            f.write(json.dumps({"op": "append", "user": "cam", "msg": msg}) + "\n")
+            f.write('{"op": "del", "us')
+
+        for path in [json_path, log_path]:
+            d = Db.replay_legacy(path)
+            self.assertEqual(
+                {u: [m.to_jsonable_type() for m in msgs] for u, msgs in d.items()},
+                {"ana": [], "cam": [msg]} if path == json_path else {"cam": [msg]},
+            )
+        self.assertIsNone(Db.replay_legacy(os.path.join(self.tmp.name, "none.json")))
+
+    async def test_records_since(self):
+        db = self.db(replication_log=5)
+        await self.fill(db, 5)
+
+        self.assertEqual(db.records_since(8), [])
+        self.assertEqual([r["seq"] for r in db.records_since(6)], [7, 8])
+        self.assertEqual([r["seq"] for r in db.records_since(3)], list(range(4, 9)))
+        # record 3 has been forgotten
+        self.assertIsNone(db.records_since(2))
+
+        # the records kept no longer lead up to the contents
+        db.reset({}, 20)
+        self.assertIsNone(db.records_since(8))
+        self.assertEqual(db.records_since(20), [])
+        db["ana"] = MessageList([])
+        self.assertEqual([r["seq"] for r in db.records_since(20)], [21])
+        self.assertIsNone(db.records_since(19))
+
+    async def test_replay_empty(self):
+        d, seq = self.replay()
+        self.assertEqual(seq, 0)
+        self.assertEqual(d, {})
+
+
+################ TESTING THE TRANSPORT ################
+
+
+# Stands in for an [asyncio.StreamWriter], for sessions that only receive
+class FakeWriter:
+    def __init__(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+    def is_closing(self):
+        return self.closed
+
+
+def packet(id, payload, more=False, flags=0):
+    header = transport.format_header(size=len(payload), id=id, more=more, flags=flags)
+    return header + payload
+
+
+class TestFraming(unittest.IsolatedAsyncioTestCase):
+    # A session reading [data], which arrives [step] bytes at a time
+    def session(self, data, step=None, **kwargs):
+        reader = asyncio.StreamReader()
+        writer = FakeWriter()
+
+        async def feed():
+            n = step or len(data)
+            for i in range(0, len(data), n):
+                reader.feed_data(data[i : i + n])
+                await asyncio.sleep(0)
+            reader.feed_eof()
+
+        self.feeder = asyncio.create_task(feed())
+        return transport.Session(reader, writer, **kwargs), writer
+
+    async def receive_all(self, session):
+        result = [msg async for msg in session]
+        await self.feeder
+        return result
+
+    async def test_short_reads(self):
+        data = (
+            packet(1, b"hel", more=True)
+            + packet(2, b"x")
+            + packet(1, b"lo ", more=True)
+            + packet(3, b"")
+            + packet(1, b"world")
+        )
+        # every header and payload is split across reads
+        session, writer = self.session(data, step=1)
+        msgs = await self.receive_all(session)
+
+        self.assertEqual(msgs, [b"x", b"", b"hello world"])
+        self.assertFalse(writer.closed)
+        self.assertEqual(session.pending_size, 0)
+
+    async def test_truncated_packet(self):
+        session, writer = self.session(packet(1, b"x") + packet(2, b"hello")[:-2])
+        msgs = await self.receive_all(session)
+
+        self.assertEqual(msgs, [b"x"])
+
+    async def test_truncated_header(self):
+        session, writer = self.session(packet(1, b"x") + packet(2, b"y")[:4])
+        msgs = await self.receive_all(session)
+
+        self.assertEqual(msgs, [b"x"])
+
+    async def test_decompress_limit(self):
+        flags = transport.CODECS["zlib"].id << transport.CODEC_SHIFT
+        data = packet(1, zlib.compress(b"a" * 100), flags=flags) + packet(
+            2, zlib.compress(b"b" * 101), flags=flags
+        )
+        session, writer = self.session(data, max_message_size=100)
+        msgs = await self.receive_all(session)
+
+        # the oversized message ends the session
+        self.assertEqual(msgs, [b"a" * 100])
+        self.assertTrue(writer.closed)
+
+    async def test_message_size_limit(self):
+        # the limit applies to the message, not to each packet
+        data = packet(1, b"x" * 8, more=True) + packet(1, b"x" * 8)
+        session, writer = self.session(data, max_message_size=15)
+        msgs = await self.receive_all(session)
+
+        self.assertEqual(msgs, [])
+        self.assertTrue(writer.closed)
+        self.assertEqual(session.pending_size, 0)
+
+    async def test_pending_limit(self):
+        data = (
+            packet(1, b"x" * 8, more=True)
+            + packet(2, b"y" * 8, more=True)
+            + packet(1, b"x")
+        )
+        session, writer = self.session(data, max_pending_bytes=15)
+        msgs = await self.receive_all(session)
+
+        self.assertEqual(msgs, [])
+        self.assertTrue(writer.closed)
+
+    async def test_global_limit(self):
+        in_use = transport.GLOBAL_REASSEMBLY.in_use
+        limit = transport.GLOBAL_REASSEMBLY.limit
+        transport.GLOBAL_REASSEMBLY.limit = in_use + 15
+        self.addCleanup(setattr, transport.GLOBAL_REASSEMBLY, "limit", limit)
+
+        first, _ = self.session(packet(1, b"x" * 8, more=True))
+        await self.receive_all(first)
+        # [first] gave back its share when it ended
+        self.assertEqual(transport.GLOBAL_REASSEMBLY.in_use, in_use)
+
+        data = packet(1, b"x" * 8, more=True) + packet(2, b"y" * 8, more=True)
+        session, writer = self.session(data)
+        msgs = await self.receive_all(session)
+
+        self.assertEqual(msgs, [])
+        self.assertTrue(writer.closed)
+        self.assertEqual(transport.GLOBAL_REASSEMBLY.in_use, in_use)
+
+
+# Two transport sessions connected to each other, with [kwargs] (and then
+# [a] or [b]) passed to each. They are closed once [test] is over.
+async def transport_pair(test, a=None, b=None, **kwargs):
+    sock_a, sock_b = socket.socketpair()
+    reader_a, writer_a = await asyncio.open_connection(sock=sock_a)
+    reader_b, writer_b = await asyncio.open_connection(sock=sock_b)
+    for writer in (writer_a, writer_b):
+        test.addAsyncCleanup(close_writer, writer)
+    return (
+        transport.Session(reader_a, writer_a, **kwargs, **(a or {})),
+        transport.Session(reader_b, writer_b, **kwargs, **(b or {})),
+    )
+
+
+async def close_writer(writer):
+    writer.close()
+    try:
+        await writer.wait_closed()
+    except OSError:
+        pass
+
+
+# Receive [n] messages on [session]
+async def receive(session, n):
+    return [await session.__anext__() for _ in range(n)]
+
+
+class TestSend(unittest.IsolatedAsyncioTestCase):
+    async def test_round_trip(self):
+        a, b = await transport_pair(self, chunk_size=1024)
+        msgs = [b"", b"small", bytes(range(256)) * 20, b"x" * 1024]
+        for msg in msgs:
+            await a.send(msg)
+
+        self.assertEqual(await receive(b, len(msgs)), msgs)
+
+    async def test_send_bytearray(self):
+        # the message is sent from views of the caller's buffer
+        a, b = await transport_pair(self, chunk_size=4)
+        buf = bytearray(b"0123456789")
+        await a.send(buf)
+
+        self.assertEqual(await receive(b, 1), [b"0123456789"])
+
+
+class TestCorking(unittest.IsolatedAsyncioTestCase):
+    async def test_coalesces_writes(self):
+        a, b = await transport_pair(self, a={"cork": True})
+        msgs = [f"note {i}".encode() for i in range(10)]
+        for msg in msgs:
+            a.send_nowait(msg)
+        # nothing is written until the end of this tick
+        self.assertEqual(a.outbox_frames, 10)
+
+        self.assertEqual(await receive(b, 10), msgs)
+        self.assertEqual(a.flushes, 1)
+        self.assertEqual(a.frames_per_flush, 10)
+
+    async def test_cork_window(self):
+        a, b = await transport_pair(self, a={"cork": True, "cork_window_us": 20_000})
+        a.send_nowait(b"first")
+        await asyncio.sleep(0)
+        a.send_nowait(b"second")
+        # still held back after a tick
+        self.assertEqual(a.outbox_frames, 2)
+
+        self.assertEqual(await receive(b, 2), [b"first", b"second"])
+        self.assertEqual(a.flushes, 1)
+
+    async def test_uncorked(self):
+        a, b = await transport_pair(self)
+        a.send_nowait(b"now")
+        self.assertEqual(a.outbox_frames, 0)
+        self.assertEqual(await receive(b, 1), [b"now"])
+
+
+# Iterate [session] in the background (so that it answers hellos), putting
+# the messages it receives on the returned queue
+def pump(test, session):
+    received = asyncio.Queue()
+
+    async def run():
+        async for msg in session:
+            received.put_nowait(msg)
+
+    task = asyncio.create_task(run())
+    test.addCleanup(task.cancel)
+    return received
+
+
+# Record the flags of every packet [session] writes
+def record_flags(session):
+    flags = []
+    write_packet = session.write_packet
+
+    def recording(header, chunk):
+        flags.append(transport.HEADER.unpack(header)[2])
+        write_packet(header, chunk)
+
+    session.write_packet = recording
+    return flags
+
+
+class TestCompression(unittest.IsolatedAsyncioTestCase):
+    async def test_negotiate(self):
+        a, b = await transport_pair(
+            self, a={"compression": "zlib"}, b={"accepting": True}
+        )
+        pump(self, a)
+        received = pump(self, b)
+        await a.negotiate()
+
+        self.assertEqual(a.send_codec, transport.CODECS["zlib"])
+        # [b] answered the hello, but didn't ask for compression itself
+        self.assertTrue(b.sent_hello)
+        self.assertIsNone(b.send_codec)
+
+        flags = record_flags(a)
+        msg = b"compress me " * 1000
+        await a.send(msg)
+        await a.send(b"too short")
+
+        self.assertEqual(await received.get(), msg)
+        self.assertEqual(await received.get(), b"too short")
+        codec = transport.CODECS["zlib"].id << transport.CODEC_SHIFT
+        self.assertEqual(flags, [codec, 0])
+
+    async def test_accepting_waits_for_hello(self):
+        a, b = await transport_pair(self, b={"compression": "zlib", "accepting": True})
+        received = pump(self, a)
+        await b.send(b"x" * 10000)
+
+        # a peer that never says hello never receives one
+        self.assertEqual(await received.get(), b"x" * 10000)
+        self.assertFalse(b.sent_hello)
+        self.assertIsNone(a.peer_codecs)
+
+
+class TestInterleaving(unittest.IsolatedAsyncioTestCase):
+    async def test_small_overtakes_large(self):
+        a, b = await transport_pair(self, chunk_size=1024)
+        large = bytes(range(256)) * 400
+        a.send_nowait(large)
+        await a.send(b"small")
+
+        # the small message only had to wait for one packet of the large one
+        self.assertEqual(await receive(b, 2), [b"small", large])
+
+    async def test_ordered(self):
+        a, b = await transport_pair(self, chunk_size=1024)
+        large = bytes(range(256)) * 400
+        a.send_nowait(large, ordered=True)
+        a.send_nowait(b"unordered")
+        a.send_nowait(b"ordered", ordered=True)
+
+        self.assertEqual(await receive(b, 3), [b"unordered", large, b"ordered"])
+
+
+################ TESTING SERIALIZATION ################
+
+
+class TestSerde(unittest.TestCase):
+    value = {"id": 1, "params": ["ünïcode", 2.5, None, True, [], {"a": [1]}]}
+
+    def test_round_trip(self):
+        for name, codec in serde.CODECS.items():
+            with self.subTest(codec=name):
+                data = codec.dumps(self.value)
+                self.assertIsInstance(data, bytes)
+                self.assertEqual(codec.loads(data), self.value)
+                self.assertEqual(serde.is_json(data), not codec.binary)
+
+    def test_wrappers(self):
+        # [to_jsonable_type] is used wherever the wrapper appears
+        msgs = MessageList([Message(User("ana"), User("cam"), "hi")])
+        expected = {"result": msgs.to_jsonable_type()}
+        for name, codec in serde.CODECS.items():
+            with self.subTest(codec=name):
+                self.assertEqual(codec.loads(codec.dumps({"result": msgs})), expected)
+                with self.assertRaises(TypeError):
+                    codec.dumps({"result": object()})
+
+    def test_decode_error(self):
+        for name, codec in serde.CODECS.items():
+            with self.subTest(codec=name):
+                with self.assertRaises(serde.DecodeError):
+                    codec.loads(b"\xc1{")
+
+    def test_get(self):
+        self.assertIs(serde.get(), serde.DEFAULT)
+        self.assertIsInstance(serde.get("json"), serde.StdlibJson)
+        with self.assertRaises(KeyError):
+            serde.get("yaml")
+        self.assertFalse(serde.is_json(b""))
+
+
+################ TESTING JSON-RPC ################
+
+
+# Wraps a plain value for handlers to return (see [jsonrpc.Jsonable])
+class Value:
+    def __init__(self, value):
+        self.value = value
+
+    def to_jsonable_type(self):
+        return self.value
+
+
+# Two JSON-RPC sessions connected to each other, both with their event loops
+# running. Arguments are as for [transport_pair], plus [rpc] which is passed
+# to both [jsonrpc.Session]s.
+async def rpc_pair(test, rpc=None, **kwargs):
+    a, b = await transport_pair(test, **kwargs)
+    sessions = jsonrpc.Session(a, **(rpc or {})), jsonrpc.Session(b, **(rpc or {}))
+    for session in sessions:
+        task = asyncio.create_task(session.run_event_loop())
+        test.addCleanup(task.cancel)
+    await asyncio.sleep(0)
+    return sessions
+
+
+BINARY_CODECS = [name for name, codec in serde.CODECS.items() if codec.binary]
+
+
+class TestEncoding(unittest.IsolatedAsyncioTestCase):
+    async def test_unsupported(self):
+        a, b = await rpc_pair(self)
+
+        self.assertIsNone(await a.negotiate_encoding("yaml"))
+        self.assertIs(a.codec, serde.DEFAULT)
+        resp = await a.request(method=jsonrpc.ENCODING_METHOD, params=["json"])
+        self.assertTrue(resp.is_error)
+        self.assertEqual(resp.payload["code"], 415)
+        self.assertIs(b.codec, serde.DEFAULT)
+
+    @unittest.skipUnless(BINARY_CODECS, "no binary encoding installed")
+    async def test_switch(self):
+        a, b = await rpc_pair(self)
+        b.register_handler("echo", lambda x: Value(x), inline=True)
+
+        name = await a.negotiate_encoding("yaml", *BINARY_CODECS)
+        self.assertEqual(name, BINARY_CODECS[0])
+        self.assertIs(a.codec, serde.CODECS[name])
+        self.assertIs(b.codec, serde.CODECS[name])
+
+        resp = await a.request(method="echo", params=[{"x": [1, "two"]}])
+        self.assertEqual(resp.payload, {"x": [1, "two"]})
+
+
+# A JSON-RPC session on one end of a connection, with its event loop running,
+# and a raw transport session on the other end to poke it with
+async def rpc_and_raw(test, **kwargs):
+    raw, b = await transport_pair(test)
+    session = jsonrpc.Session(b, **kwargs)
+    task = asyncio.create_task(session.run_event_loop())
+    test.addCleanup(task.cancel)
+    return session, raw
+
+
+class TestBatch(unittest.IsolatedAsyncioTestCase):
+    async def test_request_batch(self):
+        a, b = await rpc_pair(self)
+
+        async def add(x: int, y: int):
+            await asyncio.sleep(0.01 * x)
+            return Value(x + y)
+
+        b.register_handler("add", add)
+        resps = await a.request_batch(
+            [("add", [3, 4]), ("nope", []), ("add", [1, 1]), ("add", ["1"])]
+        )
+
+        # in the order asked, even though [add(1, 1)] finished first
+        self.assertEqual(
+            [
+                resp.payload if not resp.is_error else resp.payload["code"]
+                for resp in resps
+            ],
+            [7, 404, 2, 422],
+        )
+        self.assertEqual(a.outstanding_requests, 0)
+        self.assertEqual(await a.request_batch([]), [])
+
+    async def test_notifications(self):
+        b, raw = await rpc_and_raw(self)
+        seen = []
+        b.register_handler("note", lambda x: seen.append(x) or Ok(), inline=True)
+
+        notes = [{"jsonrpc": "2.0", "method": "note", "params": [i]} for i in range(3)]
+        await raw.send(serde.DEFAULT.dumps(notes))
+        call = {"jsonrpc": "2.0", "method": "note", "params": [3], "id": 7}
+        await raw.send(serde.DEFAULT.dumps([call, 5]))
+
+        # the batch of notifications got no response at all
+        resp, error = serde.DEFAULT.loads(await raw.__anext__())
+        self.assertEqual(resp, {"jsonrpc": "2.0", "id": 7, "result": "ok"})
+        self.assertEqual(error["error"]["code"], 400)
+        self.assertEqual(seen, [0, 1, 2, 3])
+
+    async def test_bad_batches(self):
+        b, raw = await rpc_and_raw(self)
+
+        await raw.send(b"[]")
+        resp = serde.DEFAULT.loads(await raw.__anext__())
+        self.assertEqual(resp["error"]["code"], 400)
+
+        await raw.send(b"[5]")
+        [resp] = serde.DEFAULT.loads(await raw.__anext__())
+        self.assertEqual(resp["id"], None)
+        self.assertEqual(resp["error"]["code"], 400)
+
+
+class TestRequest(unittest.IsolatedAsyncioTestCase):
+    async def test_timeout(self):
+        a, b = await rpc_pair(self, rpc={"timeout": 0.05})
+
+        async def hang():
+            await asyncio.Event().wait()
+
+        b.register_handler("hang", hang)
+        with self.assertRaises(asyncio.TimeoutError):
+            await a.request(method="hang", params=[])
+        with self.assertRaises(asyncio.TimeoutError):
+            await a.request(method="hang", params=[], timeout=0.01)
+        with self.assertRaises(asyncio.TimeoutError):
+            await a.request_nowait(method="hang", params=[])
+        with self.assertRaises(asyncio.TimeoutError):
+            await a.request_batch([("hang", [])])
+        self.assertEqual(a.outstanding_requests, 0)
+
+    async def test_handler_failure(self):
+        a, b = await rpc_pair(self)
+
+        async def fail():
+            raise RuntimeError("oops")
+
+        b.register_handler("fail", fail)
+        b.register_handler("fail_inline", lambda: 1 / 0, inline=True)
+        b.register_handler("ping", lambda: Ok(), inline=True)
+
+        for method in ["fail", "fail_inline"]:
+            resp = await a.request(method=method, params=[])
+            self.assertTrue(resp.is_error)
+            self.assertEqual(resp.payload["code"], 500)
+        # the session carries on
+        resp = await a.request(method="ping", params=[])
+        self.assertEqual(resp.payload, "ok")
+
+    async def test_disconnected(self):
+        a, b = await rpc_pair(self)
+        b.register_handler("hang", asyncio.Event().wait)
+        result = a.request_nowait(method="hang", params=[])
+        await asyncio.sleep(0.01)
+        b.close()
+
+        with self.assertRaises(Disconnected):
+            await result
+        with self.assertRaises(Disconnected):
+            await a.request(method="hang", params=[])
+
+
+class TestParams(unittest.TestCase):
+    def assertInvalid(self, handler, params, data):
+        with self.assertRaises(jsonrpc.InvalidParamsError) as cm:
+            handler.check(params)
+        self.assertEqual(cm.exception.code, 422)
+        self.assertEqual(cm.exception.data, data)
+
+    def test_arity(self):
+        def f(a, b, c=None):
+            pass
+
+        handler = jsonrpc.Handler(f)
+        handler.check([1, 2])
+        handler.check([1, 2, 3])
+        self.assertInvalid(handler, [1], "wrong number of params: 1")
+        self.assertInvalid(handler, [1, 2, 3, 4], "wrong number of params: 4")
+        self.assertInvalid(handler, {"a": 1}, "params must be a list")
+
+        handler = jsonrpc.Handler(lambda a, *rest: None)
+        handler.check([1] * 10)
+        self.assertInvalid(handler, [], "wrong number of params: 0")
+
+    def test_types(self):
+        def f(user: User, n: float, note: Optional[str], msgs: list[str], x: Ok):
+            pass
+
+        handler = jsonrpc.Handler(f)
+        handler.check(["ana", 1, None, [], "anything"])
+        handler.check(["ana", 1.5, "hi", ["a"], None])
+        self.assertInvalid(handler, [1, 1, None, [], 0], "param 0 has wrong type")
+        self.assertInvalid(handler, ["ana", "1", None, [], 0], "param 1 has wrong type")
+        self.assertInvalid(handler, ["ana", 1, 2, [], 0], "param 2 has wrong type")
+        self.assertInvalid(handler, ["ana", 1, None, {}, 0], "param 3 has wrong type")
+
+
+class TestParamsOverRpc(unittest.IsolatedAsyncioTestCase):
+    async def test_rejected_before_running(self):
+        a, b = await rpc_pair(self)
+        calls = []
+
+        async def greet(user: User):
+            calls.append(user)
+            return Ok()
+
+        b.register_handler("greet", greet)
+        for params in [[], ["ana", "cam"], [5]]:
+            resp = await a.request(method="greet", params=params)
+            self.assertEqual(resp.payload["code"], 422)
+        resp = await a.request(method="greet", params=["ana"])
+        self.assertEqual(resp.payload, "ok")
+        self.assertEqual(calls, ["ana"])
+
+
+class TestInline(unittest.IsolatedAsyncioTestCase):
+    async def test_inline(self):
+        a, b = await rpc_pair(self)
+        seen = []
+
+        def record(i: int):
+            # called straight from the event loop, with no task of its own
+            self.assertEqual(len(b.pending_jobs), 0)
+            seen.append(i)
+            return Value(i)
+
+        b.register_handler("record", record, inline=True)
+        # inline handlers don't count against the job limit
+        limit = jsonrpc.GLOBAL_JOBS.limit
+        jsonrpc.GLOBAL_JOBS.limit = 0
+        self.addCleanup(setattr, jsonrpc.GLOBAL_JOBS, "limit", limit)
+
+        results = [a.request_nowait(method="record", params=[i]) for i in range(20)]
+        resps = await asyncio.gather(*results)
+
+        self.assertEqual([resp.payload for resp in resps], list(range(20)))
+        self.assertEqual(seen, list(range(20)))
+
+    def test_rejects_coroutines(self):
+        async def handler():
+            pass
+
+        with self.assertRaises(ValueError):
+            jsonrpc.Handler(handler, inline=True)
+
+
+class TestAdmission(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.started = []
+        self.release = asyncio.Event()
+
+    async def wait(self, i: int):
+        self.started.append(i)
+        await self.release.wait()
+        return Value(i)
+
+    async def test_global_limit(self):
+        a, b = await rpc_pair(self)
+        b.register_handler("wait", self.wait)
+        in_use = jsonrpc.GLOBAL_JOBS.in_use
+        limit = jsonrpc.GLOBAL_JOBS.limit
+        jsonrpc.GLOBAL_JOBS.limit = in_use + 1
+        self.addCleanup(setattr, jsonrpc.GLOBAL_JOBS, "limit", limit)
+
+        first = a.request_nowait(method="wait", params=[0])
+        second = await a.request(method="wait", params=[1])
+        [third] = await a.request_batch([("wait", [2])])
+
+        for resp in [second, third]:
+            self.assertTrue(resp.is_error)
+            self.assertEqual(resp.payload["code"], 503)
+        self.release.set()
+        self.assertEqual((await first).payload, 0)
+        self.assertEqual(self.started, [0])
+        self.assertEqual(jsonrpc.GLOBAL_JOBS.in_use, in_use)
+
+    async def test_max_jobs(self):
+        a, b = await rpc_pair(self, rpc={"max_jobs": 2})
+        b.register_handler("wait", self.wait)
+
+        results = [a.request_nowait(method="wait", params=[i]) for i in range(5)]
+        await asyncio.sleep(0.05)
+        # the rest are left unread until a handler finishes
+        self.assertEqual(self.started, [0, 1])
+        self.assertEqual(b.active_handlers, 2)
+
+        self.release.set()
+        resps = await asyncio.gather(*results)
+        self.assertEqual([resp.payload for resp in resps], list(range(5)))
+        self.assertEqual(b.active_handlers, 0)
+
+
+class TestPipelining(unittest.IsolatedAsyncioTestCase):
+    async def test_order(self):
+        # small chunks, so that the large requests are interleaved with the rest
+        a, b = await rpc_pair(self, chunk_size=256)
+        seen = []
+        b.register_handler("record", lambda i, _: seen.append(i) or Ok(), inline=True)
+
+        results = []
+        for i in range(10):
+            padding = "x" * (5000 if i % 3 == 0 else 10)
+            if i % 4 == 1:
+                a.notify_nowait(method="record", params=[i, padding])
+            else:
+                results.append(a.request_nowait(method="record", params=[i, padding]))
+        # (answered once everything before it, notifications included, is in)
+        results.append(a.request_nowait(method="record", params=[10, ""]))
+        await asyncio.gather(*results)
+
+        self.assertEqual(seen, list(range(11)))
+        self.assertEqual(a.outstanding_requests, 0)
+
+    async def test_window(self):
+        a, b = await rpc_pair(self)
+        started = []
+        release = asyncio.Event()
+
+        async def wait(i: int):
+            started.append(i)
+            await release.wait()
+            return Value(i)
+
+        b.register_handler("wait", wait)
+        window = jsonrpc.RequestWindow(a, 2)
+        results = [
+            await window.submit(method="wait", params=[0]),
+            await window.submit(method="wait", params=[1]),
+        ]
+        third = asyncio.create_task(window.submit(method="wait", params=[2]))
+        await asyncio.sleep(0.05)
+
+        # the third request waits for room in the window
+        self.assertFalse(third.done())
+        self.assertEqual(started, [0, 1])
+        self.assertEqual(a.outstanding_requests, 2)
+
+        release.set()
+        results.append(await third)
+        await window.drain()
+        self.assertTrue(all(result.done() for result in results))
+        self.assertEqual([result.result().payload for result in results], [0, 1, 2])
+        self.assertEqual(len(window.outstanding), 0)
+
+
+################ TESTING SHARDING ################
+
+
+class TestSharding(unittest.TestCase):
+    users = [User(f"user{i}") for i in range(1000)]
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def placement(self, names):
+        ring = sharding.HashRing(names)
+        return {user: names[ring.shard_of(user)] for user in self.users}
+
+    def test_reorder(self):
+        self.assertEqual(
+            self.placement(["a", "b", "c"]), self.placement(["c", "a", "b"])
+        )
+
+    def test_add_shard(self):
+        before = self.placement(["a", "b", "c"])
+        after = self.placement(["a", "b", "c", "d"])
+
+        moved = [user for user in self.users if before[user] != after[user]]
+        self.assertTrue(all(after[user] == "d" for user in moved))
+        # roughly its share, rather than almost everyone
+        self.assertLess(len(moved), len(self.users) // 2)
+        self.assertGreater(len(moved), 0)
+
+    def load(self, data):
+        path = os.path.join(self.tmp.name, "config.json")
+        with open(path, "w") as f:
+            json.dump(data, f)
+        return config.load(path)
+
+    def test_config(self):
+        servers = [{"host": "localhost", "port": 1}]
+        a = {"name": "a", "servers": servers}
+        b = {"servers": [{"host": "localhost", "port": 2}]}
+
+        cfg = self.load({"servers": servers})
+        self.assertEqual([shard.name for shard in cfg.shards], ["0"])
+        self.assertIsNone(cfg.shard_secret)
+        # shards need names, and several of them need a secret
+        with self.assertRaises(ValueError):
+            self.load({"shards": [a, b], "shard_secret": "x"})
+        with self.assertRaises(ValueError):
+            self.load({"shards": [a, dict(b, name="b")]})
+        cfg = self.load({"shards": [a, dict(b, name="b")], "shard_secret": "x"})
+        self.assertEqual(cfg.shard_index(("localhost", 2)), 1)
+
+
+################ TESTING REPLICATION ################
+
+
+# Start a server that runs a JSON-RPC session (with [handlers]) for every
+# connection, and return its address
+async def backup(test, **handlers):
+    sessions = []
+
+    async def handle(reader, writer):
+        session = jsonrpc.spawn_session(reader, writer, accepting=True)
+        for name, action in handlers.items():
+            session.register_handler(name, action)
+        sessions.append(session)
+        await session.run_event_loop()
+
+    server = await asyncio.start_server(handle, "127.0.0.1", 0)
+    test.addAsyncCleanup(close_server, server, sessions)
+    _, port = server.sockets[0].getsockname()
+    return (Host("127.0.0.1"), Port(port))
+
+
+async def close_server(server, sessions):
+    for session in sessions:
+        session.close()
+    server.close()
+    await server.wait_closed()
+
+
+class TestReplicaLink(unittest.IsolatedAsyncioTestCase):
+    async def test_skips_failing_backups(self):
+        async def register_replica_source(seq: int):
+            return Value(seq)
+
+        first = await backup(self)
+        second = await backup(self, register_replica_source=register_replica_source)
+        tried = []
+
+        async def on_connect(next):
+            tried.append(next)
+            if len(tried) == 1:
+                raise ConnectionResetError()
+
+        info = ReplicaInfo(next=None, tail=[first, second], on_connect=on_connect)
+        next = await info.link()
+        self.addCleanup(next.close)
+
+        self.assertIs(next, tried[1])
+        self.assertFalse(tried[0].is_running)
+        self.assertEqual(info.tail, [])
+
+    async def test_writes_go_on(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        db = Db({}, os.path.join(tmp.name, "db"))
+        self.addAsyncCleanup(db.close)
+
+        async def catch_up_fails(seq: int):
+            # it is ahead of us, so we'd pull from it...
+            return Value(seq + 100)
+
+        # ...but what it sends makes no sense
+        async def fetch_records(seq: int):
+            return Value([{"op": "del"}])
+
+        addr = await backup(
+            self, register_replica_source=catch_up_fails, fetch_records=fetch_records
+        )
+        cfg = config.Config([config.Shard("0", [("127.0.0.1", 1), addr])])
+        state = State(cfg, cfg[0], db, True, ReplicaInfo(next=None, tail=[addr]))
+
+        await state.replica_info.link()
+        db["ana"] = MessageList([])
+        await asyncio.wait_for(state.replicate(), 5)
+
+        self.assertIsNone(state.replica_info.next)
+        self.assertEqual(state.acked_seq, db.seq)
@@ -1,26 +1,172 @@
 import struct
 import asyncio
-from collections import defaultdict, abc
-from typing import NewType, DefaultDict
+import zlib
+from collections import abc, deque
+from typing import NewType, Optional, Union, Callable
+
+try:
+    import lz4.frame  # type: ignore
+except ImportError:
+    lz4 = None
 
 MsgId = NewType("MsgId", int)
 
 # 4 bytes
-MAX_MSG_SIZE = 1 << 32 - 1
+MAX_MSG_SIZE = (1 << 32) - 1
 MAX_ID = 1 << 32
 
 # > = big endian
-# l = 4 bytes (size)
-# l = 4 bytes (id)
-# b = 1 byte (more?)
-HEADER_FORMAT = ">llb"
-HEADER_SIZE = 4 + 4 + 1
+# L = 4 bytes (size)
+# L = 4 bytes (id)
+# B = 1 byte (flags; see below)
+#
+# Both 4-byte fields are unsigned; with signed fields, any size or id at or
+# above [2**31] would fail to pack (or unpack to a negative length).
+HEADER_FORMAT = ">LLB"
+# Compiling the format once saves re-parsing it on every packet
+HEADER = struct.Struct(HEADER_FORMAT)
+HEADER_SIZE = HEADER.size
+
+# Flag bits. Bit 0 has always meant "more packets with this ID follow", so
+# peers that predate the other bits are unaffected as long as nobody sends
+# them compressed data or a hello (which only happens after a handshake, or
+# when explicitly enabled on the side that opened the connection).
+FLAG_MORE = 0x01
+# The packet is a capability announcement (see [Session.negotiate]) and is
+# consumed by the transport rather than being returned to the caller.
+FLAG_HELLO = 0x02
+# Bits 2-3 hold the id of the codec the message payload is compressed with
+# (0 = uncompressed).
+CODEC_SHIFT = 2
+CODEC_MASK = 0x03 << CODEC_SHIFT
 
 STRING_ENCODING = "utf8"
 
+# Messages shorter than this are never worth compressing
+DEFAULT_COMPRESS_THRESHOLD = 4096
+
+# Limits on how much memory reassembling incoming messages may take: the size
+# of any one (decompressed) message, the total held by partially-received
+# messages in one session, and the total across all sessions in the process
+# (see [GLOBAL_REASSEMBLY]).
+DEFAULT_MAX_MESSAGE_SIZE = 512 * 1024 * 1024
+DEFAULT_MAX_PENDING_BYTES = 512 * 1024 * 1024
+DEFAULT_GLOBAL_REASSEMBLY_LIMIT = 2 * 1024 * 1024 * 1024
+
+# Messages are split into packets of at most this many bytes so that packets
+# of concurrently-sent messages can be interleaved (see [Session.send]).
+DEFAULT_CHUNK_SIZE = 64 * 1024
+
+
+class Codec:
+    id: int
+    name: str
+    compress: Callable[[bytes], bytes]
+    # decompress(payload, max_length) -> result, or None if the result would
+    # be longer than [max_length]
+    decompress: Callable[[bytes, int], Optional[bytes]]
+
+    def __init__(self, id, name, compress, decompress):
+        self.id = id
+        self.name = name
+        self.compress = compress
+        self.decompress = decompress
+
+
+# Decompression is bounded so that a small malicious payload cannot expand
+# past the message size limit.
+def zlib_decompress(payload: bytes, max_length: int) -> Optional[bytes]:
+    d = zlib.decompressobj()
+    result = d.decompress(payload, max_length)
+    if d.unconsumed_tail or not d.eof:
+        return None
+    return result
+
+
+def lz4_decompress(payload: bytes, max_length: int) -> Optional[bytes]:
+    d = lz4.frame.LZ4FrameDecompressor()
+    result = d.decompress(payload, max_length)
+    if not d.eof:
+        return None
+    return result
+
+
+# Compression codecs we can speak, by name. lz4 is optional.
+CODECS: dict[str, Codec] = {"zlib": Codec(1, "zlib", zlib.compress, zlib_decompress)}
+if lz4 is not None:
+    CODECS["lz4"] = Codec(2, "lz4", lz4.frame.compress, lz4_decompress)
+CODECS_BY_ID: dict[int, Codec] = {codec.id: codec for codec in CODECS.values()}
+
+
+# Process-wide accounting of memory used by incoming messages that are still
+# being read. Sessions reserve space here before reading a packet's payload,
+# so a packet that would exceed the limit is rejected based on its declared
+# size alone.
+class ReassemblyBudget:
+    limit: int
+    in_use: int
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.in_use = 0
+
+    def reserve(self, n: int) -> bool:
+        if self.in_use + n > self.limit:
+            return False
+        self.in_use += n
+        return True
+
+    def release(self, n: int) -> None:
+        self.in_use -= n
+
+
+# Shared by every session; set [GLOBAL_REASSEMBLY.limit] to configure.
+GLOBAL_REASSEMBLY = ReassemblyBudget(DEFAULT_GLOBAL_REASSEMBLY_LIMIT)
+
+
+# An incoming message of which only some packets have arrived
+class PartialMessage:
+    chunks: list[bytes]
+    size: int
+
+    def __init__(self):
+        self.chunks = []
+        self.size = 0
+
+
+# An outgoing message that is (partially) waiting in a session's send queue
+class Stream:
+    id: MsgId
+    view: memoryview
+    offset: int
+    flags: int
+    # an earlier ordered message that must be written out before this one
+    # starts; see [Session.start_send]
+    after: Optional["Stream"]
+    # set once the last packet has been written
+    finished: bool
+    # resolved at the same time (unless cancelled by the sender)
+    done: asyncio.Future
+
+    def __init__(self, id, view, flags, after=None):
+        self.id = id
+        self.view = view
+        self.offset = 0
+        self.flags = flags
+        self.after = after
+        self.finished = False
+        self.done = asyncio.get_running_loop().create_future()
+
+
+# Raised when the peer sends something we cannot make sense of. The session
+# cannot recover from this, so iteration stops.
+class ProtocolError(Exception):
+    pass
+
+
 # Format header data as bytes according to HEADER_FORMAT
-def format_header(*, size: int, id: MsgId, more: bool):
-    return struct.pack(HEADER_FORMAT, size, id, more)
+def format_header(*, size: int, id: MsgId, more: bool, flags: int = 0):
+    return HEADER.pack(size, id, flags | more)
 
 
 # Calculate the next message ID
@@ -39,14 +185,110 @@ class Session(abc.AsyncIterator[bytes]):
     # [self.pending_msgs] is safe provided that we don't [await] while the
     # dictionary is in some intermediate state. Also, dictionaries should have
     # atomic operations when used with primitive keys, so it'd be fine anyway.
-    pending_msgs: DefaultDict[MsgId, bytes]
+    #
+    # Each chunk is only read once its size (from its header) has been
+    # checked against the limits below. Chunks are collected in a list and
+    # joined once the final chunk arrives, so reassembling a message copies
+    # each byte once rather than once per chunk (as repeated [bytes +=] would).
+    pending_msgs: dict[MsgId, PartialMessage]
+    # Memory limits; see [DEFAULT_MAX_MESSAGE_SIZE]. [pending_size] is the
+    # total size of [pending_msgs].
+    max_message_size: int
+    max_pending_bytes: int
+    pending_size: int
+
+    # Corking: when enabled, packets are not written to the socket right away
+    # but collected in [outbox] and written together by [flush], which is
+    # scheduled for the end of the current event-loop tick (or after
+    # [cork_window] seconds, if nonzero). Many small notifications sent in one
+    # "breath" then cost a single socket write instead of one each.
+    cork: bool
+    cork_window: float
+    outbox: list[Union[bytes, memoryview]]
+    outbox_size: int
+    outbox_frames: int
+    flush_handle: Optional[asyncio.Handle]
+    # Counters for [frames_per_flush]
+    flushes: int
+    frames_flushed: int
+
+    # Compression: [compression] names the codec we would like to send with.
+    # We only actually compress once the peer's hello has told us it can
+    # decompress that codec; [send_codec] is set at that point. Incoming
+    # compressed messages are always accepted if we know the codec.
+    # [accepting] marks sessions on connections we accepted: those never start
+    # the handshake, and only send a hello in answer to the peer's, so that
+    # clients which predate hellos never receive one.
+    compression: Optional[str]
+    accepting: bool
+    compress_threshold: int
+    send_codec: Optional[Codec]
+    sent_hello: bool
+    peer_codecs: Optional[frozenset[str]]
+    got_hello: asyncio.Event
+
+    # Multiplexing: messages that don't fit in a single packet are queued in
+    # [streams], and [scheduler] writes them out round-robin, at most
+    # [stream_window] bytes of one message per turn. A huge message therefore
+    # delays a small one queued behind it by one window, not by its whole
+    # length. The peer already reassembles packets by message ID, so no
+    # change on the receiving side is necessary. This means messages can
+    # complete out of the order they were sent in; those sent with [ordered]
+    # set are the exception, and complete in order relative to each other
+    # ([last_ordered] is the latest of them still queued).
+    chunk_size: int
+    stream_window: int
+    streams: deque[Stream]
+    last_ordered: Optional[Stream]
+    scheduler: Optional[asyncio.Task]
 
     # Initialize session
-    def __init__(self, reader, writer):
+    def __init__(
+        self,
+        reader,
+        writer,
+        *,
+        cork=False,
+        cork_window_us=0,
+        compression=None,
+        accepting=False,
+        compress_threshold=DEFAULT_COMPRESS_THRESHOLD,
+        chunk_size=DEFAULT_CHUNK_SIZE,
+        stream_window=None,
+        max_message_size=DEFAULT_MAX_MESSAGE_SIZE,
+        max_pending_bytes=DEFAULT_MAX_PENDING_BYTES,
+    ):
         self.curr_id = MsgId(0)
         self.reader = reader
         self.writer = writer
-        self.pending_msgs = defaultdict(bytes)
+        self.pending_msgs = dict()
+        self.max_message_size = max_message_size
+        self.max_pending_bytes = max_pending_bytes
+        self.pending_size = 0
+        self.cork = cork
+        self.cork_window = cork_window_us / 1_000_000
+        self.outbox = []
+        self.outbox_size = 0
+        self.outbox_frames = 0
+        self.flush_handle = None
+        self.flushes = 0
+        self.frames_flushed = 0
+        if compression is not None and compression not in CODECS:
+            raise ValueError(f"unsupported compression codec: {compression}")
+        self.compression = compression
+        self.accepting = accepting
+        self.compress_threshold = compress_threshold
+        self.send_codec = None
+        self.sent_hello = False
+        self.peer_codecs = None
+        self.got_hello = asyncio.Event()
+        if not 0 < chunk_size <= MAX_MSG_SIZE:
+            raise ValueError(f"chunk size out of range: {chunk_size}")
+        self.chunk_size = chunk_size
+        self.stream_window = chunk_size if stream_window is None else stream_window
+        self.streams = deque()
+        self.last_ordered = None
+        self.scheduler = None
 
     # Get the next fresh message ID in this session
     def fresh_id(self) -> MsgId:
@@ -54,40 +296,289 @@ class Session(abc.AsyncIterator[bytes]):
         self.curr_id = increment_msgid(self.curr_id)
         return prev
 
+    # Is the outgoing buffer (the transport's, plus anything still corked)
+    # above the transport's high-water mark? Below that mark, [drain] would
+    # return immediately anyway, so we skip it.
+    def above_high_water(self) -> bool:
+        transport = self.writer.transport
+        _, high = transport.get_write_buffer_limits()
+        return transport.get_write_buffer_size() + self.outbox_size > high
+
+    # Write a single packet, or queue it for the next [flush] if corked
+    def write_packet(self, header: bytes, chunk: memoryview) -> None:
+        if not self.cork:
+            self.writer.writelines([header, chunk])
+            return
+
+        self.outbox.append(header)
+        self.outbox.append(chunk)
+        self.outbox_size += len(header) + len(chunk)
+        self.outbox_frames += 1
+        if self.flush_handle is None:
+            loop = asyncio.get_running_loop()
+            if self.cork_window > 0:
+                self.flush_handle = loop.call_later(self.cork_window, self.flush)
+            else:
+                self.flush_handle = loop.call_soon(self.flush)
+
+    # Write out every corked packet in one go
+    def flush(self) -> None:
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        if self.outbox_frames == 0:
+            return
+        if not self.writer.is_closing():
+            self.writer.writelines(self.outbox)
+        self.flushes += 1
+        self.frames_flushed += self.outbox_frames
+        self.outbox = []
+        self.outbox_size = 0
+        self.outbox_frames = 0
+
+    # Average number of packets coalesced into each corked write
+    @property
+    def frames_per_flush(self) -> float:
+        if self.flushes == 0:
+            return 0.0
+        return self.frames_flushed / self.flushes
+
+    # Announce which codecs we can decompress. This is sent at most once per
+    # session.
+    def send_hello(self) -> None:
+        self.sent_hello = True
+        payload = ",".join(CODECS).encode(STRING_ENCODING)
+        header = format_header(
+            size=len(payload), id=self.fresh_id(), more=False, flags=FLAG_HELLO
+        )
+        self.write_packet(header, memoryview(payload))
+
+    # Handle the peer's hello: remember its codecs, and answer with our own
+    # hello if we haven't sent one yet so that the handshake always completes.
+    def receive_hello(self, payload: bytes) -> None:
+        names = bytes(payload).decode(STRING_ENCODING)
+        self.peer_codecs = frozenset(name for name in names.split(",") if name)
+        if self.compression is not None and self.compression in self.peer_codecs:
+            self.send_codec = CODECS[self.compression]
+        if not self.sent_hello:
+            self.send_hello()
+        self.got_hello.set()
+
+    # Perform the capability handshake and wait for it to complete. This
+    # requires the session to be iterated concurrently (so that the peer's
+    # hello is received). Sessions that have [compression] set will start the
+    # handshake on their first [send] anyway; calling this first just ensures
+    # that large first messages are compressed too. [accepting] sessions just
+    # wait for the peer to start it.
+    async def negotiate(self) -> None:
+        if not self.sent_hello and not self.accepting:
+            self.send_hello()
+            self.flush()
+        await self.got_hello.wait()
+
     # Send a single message (s) in bytes
     # by breaking down the message into packets
     # and sending each packet in order
     async def send(self, s: bytes) -> None:
+        done = self.start_send(s)
+        if done is not None:
+            # wait for the scheduler to get through it
+            await done
+        elif self.above_high_water():
+            # no point holding packets back if we're going to wait anyway
+            self.flush()
+            await self.writer.drain()
+
+    # Send a message without waiting for it to be written out, or for the
+    # write buffer to drain. This is for small replies that are produced
+    # outside of any task; [send] should be preferred otherwise. See
+    # [start_send] for [ordered].
+    def send_nowait(self, s: bytes, *, ordered: bool = False) -> None:
+        done = self.start_send(s, ordered=ordered)
+        if done is not None:
+            # nobody is waiting on this, so make sure a failure isn't reported
+            # as an unretrieved exception
+            done.add_done_callback(lambda f: f.cancelled() or f.exception())
+
+    # Helper: write [s] right away if possible, or queue it for the scheduler
+    # and return a future that resolves once it has been written. If
+    # [ordered] is set, the peer receives [s] after every earlier message
+    # sent with [ordered] set, even if those are still being interleaved with
+    # others.
+    def start_send(
+        self, s: bytes, *, ordered: bool = False
+    ) -> Optional[asyncio.Future]:
+        if self.compression is not None and not (self.sent_hello or self.accepting):
+            self.send_hello()
+
         # generate a new ID for this message
         msg_id = self.fresh_id()
 
-        # for each chunk of the message,
-        # assemble a packet with the corresponding header and send it
-        for i in range(0, len(s), MAX_MSG_SIZE):
-            chunk = s[i : i + MAX_MSG_SIZE]
-            more = bool(s[i + MAX_MSG_SIZE :])
-            header = format_header(size=len(chunk), id=msg_id, more=more)
-            packet = header + chunk
-            self.writer.write(packet)
-            await self.writer.drain()
+        flags = 0
+        codec = self.send_codec
+        if codec is not None and len(s) >= self.compress_threshold:
+            compressed = codec.compress(s)
+            # incompressible data is sent as-is
+            if len(compressed) < len(s):
+                s = compressed
+                flags = codec.id << CODEC_SHIFT
+
+        # Slicing a [memoryview] does not copy the underlying bytes, and
+        # [writelines] hands the header and chunk to the transport as
+        # separate buffers instead of concatenating them into a new packet.
+        view = memoryview(s)
+
+        # fast path: nothing is queued ahead of us and the message fits in a
+        # single packet (an empty message is still sent as one empty packet)
+        if not self.streams and len(view) <= self.chunk_size:
+            header = format_header(size=len(view), id=msg_id, more=False, flags=flags)
+            self.write_packet(header, view)
+            return None
+
+        # otherwise, queue the message for the scheduler
+        stream = Stream(msg_id, view, flags)
+        if ordered:
+            last = self.last_ordered
+            if last is not None and not last.finished:
+                stream.after = last
+            self.last_ordered = stream
+        self.streams.append(stream)
+        if self.scheduler is None:
+            self.scheduler = asyncio.create_task(self.run_scheduler())
+        return stream.done
+
+    # Write out queued messages, taking turns between them
+    async def run_scheduler(self) -> None:
+        try:
+            while self.streams:
+                stream = self.streams.popleft()
+                if stream.after is not None:
+                    if not stream.after.finished:
+                        # wait for our turn; [after] is further up the queue
+                        self.streams.append(stream)
+                        continue
+                    stream.after = None
+                total = len(stream.view)
+                budget = self.stream_window
+                # for each chunk of the message (up to this stream's window),
+                # assemble a packet with the corresponding header and send it
+                while True:
+                    start = stream.offset
+                    chunk = stream.view[start : start + self.chunk_size]
+                    stream.offset += len(chunk)
+                    more = stream.offset < total
+                    header = format_header(
+                        size=len(chunk), id=stream.id, more=more, flags=stream.flags
+                    )
+                    self.write_packet(header, chunk)
+                    budget -= len(chunk)
+                    if not more or budget <= 0:
+                        break
+
+                if more:
+                    self.streams.append(stream)
+                else:
+                    stream.finished = True
+                    # the sender may have been cancelled in the meantime; we
+                    # still send the rest of the message so the peer isn't
+                    # left with a partial one
+                    if not stream.done.done():
+                        stream.done.set_result(None)
+
+                if self.above_high_water():
+                    self.flush()
+                    await self.writer.drain()
+                elif self.streams:
+                    # give other senders a chance to queue up before the next
+                    # round
+                    await asyncio.sleep(0)
+        except Exception as e:
+            # the connection is gone; fail everyone still waiting
+            for stream in self.streams:
+                if not stream.done.done():
+                    stream.done.set_exception(e)
+            self.streams.clear()
+        finally:
+            self.scheduler = None
+
+    # Check a packet's declared size against the limits before reading its
+    # payload, and reserve space for it in the global budget
+    def admit(self, size: int, partial: Optional[PartialMessage]) -> None:
+        so_far = 0 if partial is None else partial.size
+        if so_far + size > self.max_message_size:
+            raise ProtocolError(f"message exceeds {self.max_message_size} bytes")
+        if self.pending_size + size > self.max_pending_bytes:
+            raise ProtocolError(
+                f"partial messages exceed {self.max_pending_bytes} bytes"
+            )
+        if not GLOBAL_REASSEMBLY.reserve(size):
+            raise ProtocolError("global reassembly limit reached")
+
+    # Drop every partially-received message, e.g. once the peer is gone
+    def discard_pending(self) -> None:
+        GLOBAL_REASSEMBLY.release(self.pending_size)
+        self.pending_msgs.clear()
+        self.pending_size = 0
 
     # Receive a single message in bytes
     async def recv_single(self) -> bytes:
         # loop to receive all incoming packets
         while True:
-            # for each packet, read and unpack header, then read chunk
-            header = await self.reader.read(HEADER_SIZE)
-            size, id, more = struct.unpack(HEADER_FORMAT, header)
-            chunk = await self.reader.read(size)
+            # for each packet, read and unpack header, then read chunk.
+            # [reader.read(n)] may return fewer than [n] bytes if the packet
+            # was split in transit, so we must use [readexactly] here. If the
+            # connection closes partway, this raises [IncompleteReadError]
+            # (a subclass of [EOFError]).
+            header = await self.reader.readexactly(HEADER_SIZE)
+            size, id, flags = HEADER.unpack(header)
             id = MsgId(id)
-            # add this chunk to the corresponding pending message by id
-            self.pending_msgs[id] += chunk
+            partial = self.pending_msgs.get(id)
+            self.admit(size, partial)
+            # (the payload is copied once, out of the stream's buffer)
+            try:
+                chunk = await self.reader.readexactly(size)
+            finally:
+                GLOBAL_REASSEMBLY.release(size)
+
+            if flags & FLAG_HELLO:
+                self.receive_hello(chunk)
+                continue
+            more = flags & FLAG_MORE
+            # fast path: a single-packet message needs no reassembly
+            if partial is None and not more:
+                return self.decompress(chunk, flags)
+
+            # add this chunk to the corresponding pending message by id. It
+            # was admitted above, so this reservation cannot fail.
+            GLOBAL_REASSEMBLY.reserve(size)
+            self.pending_size += size
+            if partial is None:
+                partial = self.pending_msgs[id] = PartialMessage()
+            partial.chunks.append(chunk)
+            partial.size += size
             # if this is the last chunk, the message is fully received
             if not more:
-                payload = self.pending_msgs[id]
                 # delete from pending and return full message
                 del self.pending_msgs[id]
-                return payload
+                self.pending_size -= partial.size
+                GLOBAL_REASSEMBLY.release(partial.size)
+                return self.decompress(b"".join(partial.chunks), flags)
+
+    # Undo whatever compression the [flags] of a message say was applied
+    def decompress(self, payload: bytes, flags: int) -> bytes:
+        codec_id = (flags & CODEC_MASK) >> CODEC_SHIFT
+        if codec_id == 0:
+            return payload
+        codec = CODECS_BY_ID.get(codec_id)
+        if codec is None:
+            raise ProtocolError(f"unknown compression codec id: {codec_id}")
+        try:
+            result = codec.decompress(payload, self.max_message_size)
+        except Exception as e:
+            raise ProtocolError("could not decompress message") from e
+        if result is None:
+            raise ProtocolError(f"message exceeds {self.max_message_size} bytes")
+        return result
 
     # Initialize iterator for session
     def __aiter__(self) -> abc.AsyncIterator[bytes]:
@@ -98,4 +589,10 @@ class Session(abc.AsyncIterator[bytes]):
         try:
             return await self.recv_single()
         except (EOFError, asyncio.CancelledError, struct.error):
+            self.discard_pending()
+            raise StopAsyncIteration
+        except ProtocolError:
+            # the peer misbehaved, so don't keep its connection around either
+            self.discard_pending()
+            self.writer.close()
             raise StopAsyncIteration